@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""compare writing an HxZip label field with one zlib stream and with
+blocks compressed in a thread pool
+
+Usage: python benchmarks/parallel_zip.py [--size 256] [--threads 4] [--level 6] [--block-bytes 1048576]
+
+A synthetic size^3 label field is written to a temporary directory with
+write_amira(encoding='HxZip'), first with threads=None and then with
+the given number of threads, and read back to check it.
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import py_amira_file_reader.read_amira as read_amira
+from py_amira_file_reader.write_amira import write_amira
+
+def make_labels(size):
+    z, y, x = np.mgrid[0:size, 0:size, 0:size]
+    labels = ((x//16 + y//16 + z//16) % 8).astype(np.uint8)
+    rng = np.random.RandomState(0)
+    band = slice(size//2, size//2 + max(size//64, 1))
+    labels[:, band, :] = rng.randint(0, 8, size=labels[:, band, :].shape)
+    return labels
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256,
+                        help='edge length of the label field')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='number of threads compressing blocks')
+    parser.add_argument('--level', type=int, default=6,
+                        help='zlib compression level')
+    parser.add_argument('--block-bytes', type=int, default=1024*1024,
+                        help='bytes of data compressed per block')
+    args = parser.parse_args()
+
+    arr = make_labels(args.size)
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'labels.am')
+        for threads in [None, args.threads]:
+            t0 = time.time()
+            written = write_amira(fname, arr, encoding='HxZip', level=args.level, threads=threads,
+                                  chunk_bytes=args.block_bytes)
+            dur = time.time() - t0
+            actual = read_amira.read_amira(fname)['data'][-1]['data']
+            assert (actual == arr).all()
+            n_blocks = len(written['blocks']) if written['blocks'] else 1
+            print('threads=%-4s %8.3f s (%8.1f MB/s), %d bytes in %d blocks' % (
+                threads, dur, arr.nbytes/1e6/dur, written['size'], n_blocks))
+    finally:
+        shutil.rmtree(outdir)
+
+if __name__=='__main__':
+    main()
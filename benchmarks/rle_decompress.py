@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""compare the vectorized HxByteRLE decoder with the original per-byte loop
+
+Usage: python benchmarks/rle_decompress.py [--size 512]
+
+A synthetic label field of size^3 voxels (nested boxes of labels with a
+noisy band, so both runs and literal blocks occur) is RLE encoded and
+then decoded with both implementations.
+"""
+from __future__ import print_function
+import argparse
+import time
+
+import numpy as np
+
+import py_amira_file_reader.read_amira as read_amira
+
+def rle_decompress_loop(buf):
+    # the original implementation, one control byte at a time
+    buf = memoryview(buf)
+    result = []
+    idx = 0
+    buflen = len(buf)
+    while idx < buflen:
+        control_byte = ord(buf[idx:idx+1].tobytes())
+        idx += 1
+        if control_byte==0:
+            break
+        elif control_byte <= 127:
+            repeats = control_byte
+            new_byte = buf[idx:idx+1].tobytes()
+            idx += 1
+            result.append( new_byte*repeats )
+        else:
+            num_bytes = control_byte-128
+            new_bytes = buf[idx:idx+num_bytes]
+            idx += num_bytes
+            result.append( new_bytes )
+    return b''.join(result)
+
+def rle_compress(arr):
+    # runs of two or more bytes are repeats, everything else literals
+    data = np.ascontiguousarray(arr).reshape(-1)
+    boundaries = np.flatnonzero(np.diff(data)) + 1
+    starts = np.concatenate(([0], boundaries))
+    lengths = np.diff(np.concatenate((starts, [len(data)])))
+    values = data[starts]
+    result = []
+    literal = []
+    def flush_literal():
+        while len(literal):
+            block = bytes(bytearray(literal[:127]))
+            del literal[:127]
+            result.append(bytes(bytearray([128+len(block)])) + block)
+    for value, length in zip(values.tolist(), lengths.tolist()):
+        if length == 1:
+            literal.append(value)
+            continue
+        flush_literal()
+        while length > 0:
+            n = min(length, 127)
+            result.append(bytes(bytearray([n, value])))
+            length -= n
+    flush_literal()
+    return b''.join(result)
+
+def make_labels(size):
+    arr = np.zeros((size, size, size), dtype=np.uint8)
+    step = max(size//16, 1)
+    for label in range(1, 8):
+        lo = label*step
+        hi = size - label*step
+        if hi <= lo:
+            break
+        arr[lo:hi, lo:hi, lo:hi] = label
+    rng = np.random.RandomState(0)
+    band = slice(size//2, size//2 + max(size//64, 1))
+    arr[:, band, :] = rng.randint(0, 255, size=arr[:, band, :].shape)
+    return arr
+
+def timeit(func, repeat):
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        result = func()
+        dur = time.time() - t0
+        if best is None or dur < best:
+            best = dur
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=512,
+                        help='edge length of the label field')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='repeats of the vectorized decoder (best is shown)')
+    args = parser.parse_args()
+
+    arr = make_labels(args.size)
+    encoded = rle_compress(arr)
+    print('label field: %d^3 voxels, %d bytes RLE encoded' % (args.size, len(encoded)))
+
+    dur_loop, expected = timeit(lambda: rle_decompress_loop(encoded), 1)
+    out = np.empty(arr.size, dtype=np.uint8)
+    dur_vec, actual = timeit(lambda: read_amira.rle_decompress_into(encoded, out), args.repeat)
+
+    assert actual.tobytes() == expected
+    assert actual.tobytes() == arr.tobytes()
+
+    mb = arr.nbytes / 1e6
+    print('per-byte loop: %8.3f s (%8.1f MB/s)' % (dur_loop, mb/dur_loop))
+    print('vectorized:    %8.3f s (%8.1f MB/s)' % (dur_vec, mb/dur_vec))
+    print('speedup:       %8.1fx' % (dur_loop/dur_vec))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""compare decoding the data sections of a multi-field file one at a time
+and concurrently in a thread pool
+
+Usage: python benchmarks/threaded_decode.py [--size 256] [--fields 4]
+
+A binary AmiraMesh file with a label field and several float fields on
+one size^3 lattice, all HxZip encoded, is written to a temporary
+directory and then read with threads=None and threads=fields.
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+import py_amira_file_reader.read_amira as read_amira
+
+def write_fields(fname, size, n_fields):
+    rng = np.random.RandomState(0)
+    z, y, x = np.mgrid[0:size, 0:size, 0:size]
+    labels = ((x//16 + y//16 + z//16) % 8).astype(np.uint8)
+    fields = [('byte', 'Labels', labels)]
+    for i in range(1, n_fields):
+        # smooth but not constant, so it compresses only a little
+        values = np.sin(x*0.05*i) + np.cos(y*0.03) + 0.01*rng.randn(size, size, size)
+        fields.append(('float', 'Field%d'%i, values.astype('>f4')))
+    encoded = [zlib.compress(arr.tobytes(), 6) for _, _, arr in fields]
+    with open(fname, mode='wb') as fd:
+        fd.write(b'# AmiraMesh 3D BINARY 2.0\n\n')
+        fd.write(('define Lattice %d %d %d\n\n'%(size, size, size)).encode())
+        fd.write(b'Parameters {\n    CoordType "uniform"\n}\n\n')
+        for i, ((element_type, name, _), data) in enumerate(zip(fields, encoded)):
+            fd.write(('Lattice { %s %s } @%d(HxZip,%d)\n'%(element_type, name, i+1, len(data))).encode())
+        fd.write(b'\n')
+        for i, data in enumerate(encoded):
+            fd.write(('@%d\n'%(i+1)).encode())
+            fd.write(data)
+            fd.write(b'\n\n')
+    return sum(arr.nbytes for _, _, arr in fields)
+
+def timeit(func, repeat):
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        result = func()
+        dur = time.time() - t0
+        if best is None or dur < best:
+            best = dur
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256,
+                        help='edge length of the lattice')
+    parser.add_argument('--fields', type=int, default=4,
+                        help='number of data sections')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='repeats of each read (best is shown)')
+    args = parser.parse_args()
+
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'fields.am')
+        nbytes = write_fields(fname, args.size, args.fields)
+        print('%d fields on a %d^3 lattice, %.1f MB decoded' % (args.fields, args.size, nbytes/1e6))
+
+        dur_serial, expected = timeit(lambda: read_amira.read_amira(fname), args.repeat)
+        dur_threads, actual = timeit(lambda: read_amira.read_amira(fname, threads=args.fields), args.repeat)
+    finally:
+        shutil.rmtree(outdir)
+
+    for row, expected_row in zip(actual['data'], expected['data']):
+        if 'data' in row:
+            assert (row['data'] == expected_row['data']).all()
+
+    print('one at a time: %8.3f s' % dur_serial)
+    print('threads=%d:     %8.3f s' % (args.fields, dur_threads))
+    print('speedup:       %8.1fx' % (dur_serial/dur_threads))
+
+if __name__=='__main__':
+    main()
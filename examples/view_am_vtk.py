@@ -9,7 +9,8 @@ import vtk
 import argparse
 
 def show_file(fname,gpu=False):
-    data = read_amira.read_amira( fname )
+    # VTK wants x fastest in C contiguous memory, as stored in the file
+    data = read_amira.read_amira( fname, order='zyx-C' )
     dlist = data['data']
     merged = {}
     for row in dlist:
@@ -17,7 +18,7 @@ def show_file(fname,gpu=False):
     if 'data' not in merged:
         print('Only binary .am files are supported',file=sys.stderr)
         sys.exit(1)
-    arr = merged['data']
+    arr = merged['data'] # indexed (z, y, x)
 
     dictRGB = {}
     if 'Materials' in merged['Parameters']:
@@ -33,17 +34,17 @@ def show_file(fname,gpu=False):
         # For VTK to be able to use the data, it must be stored as a VTK-image. This can be done by the vtkImageImport-class which
         # imports raw data and stores it.
         dataImporter = vtk.vtkImageImport()
-        # The preaviusly created array is converted to a string of chars and imported.
-        data_string = arr.tostring()
-        dataImporter.CopyImportVoidPointer(data_string, len(data_string))
+        # The array is imported in place, without a copy. It must stay
+        # alive as long as the importer is used.
+        dataImporter.SetImportVoidPointer(arr)
         # The type of the newly imported data is set to unsigned char (uint8)
         dataImporter.SetDataScalarTypeToUnsignedChar()
         # Because the data that is imported only contains an intensity value (it isnt RGB-coded or someting similar), the importer
         # must be told this is the case.
         dataImporter.SetNumberOfScalarComponents(1)
 
-        dataImporter.SetDataExtent (0, arr.shape[0]-1, 0, arr.shape[1]-1, 0, arr.shape[2]-1)
-        dataImporter.SetWholeExtent(0, arr.shape[0]-1, 0, arr.shape[1]-1, 0, arr.shape[2]-1)
+        dataImporter.SetDataExtent (0, arr.shape[2]-1, 0, arr.shape[1]-1, 0, arr.shape[0]-1)
+        dataImporter.SetWholeExtent(0, arr.shape[2]-1, 0, arr.shape[1]-1, 0, arr.shape[0]-1)
 
     if 1:
         # from https://pyscience.wordpress.com/2014/11/16/volume-rendering-with-python-and-vtk/
@@ -3,7 +3,7 @@ from __future__ import print_function
 
 import py_amira_file_reader.read_amira as read_amira
 import numpy as np
-import sys, os
+import sys, os, zlib
 
 import nrrd # called pynrrd on PyPI
 
@@ -18,7 +18,7 @@ def escape(value):
     return valstr
 
 def to_csv(csv_data,csv_fname):
-    colnames = csv_data.keys()
+    colnames = list(csv_data.keys())
     with open(csv_fname,mode='w') as fd:
         fd.write( ','.join( map(escape, colnames) ) + '\n' )
         idx = 0
@@ -32,17 +32,8 @@ def to_csv(csv_data,csv_fname):
             fd.write( ','.join(map(escape, line_values)) + '\n' )
             idx += 1
 
-def convert_file(fname,csv_fname,nrrd_fname):
-    data = read_amira.read_amira( fname )
-    dlist = data['data']
-    merged = {}
-    for row in dlist:
-        merged.update(row)
-    if 'data' not in merged:
-        print('Only binary .am files are supported',file=sys.stderr)
-        sys.exit(1)
-    arr = merged['data']
-
+def materials_csv_data(parameters):
+    """the id and name of each material, as columns"""
     csv_data = {'id':[],
                 'name':[],
                 }
@@ -51,36 +42,188 @@ def convert_file(fname,csv_fname,nrrd_fname):
     # with no Id.
     ok_to_guess_ids = True
 
-    for name_enum,name in enumerate(merged['Parameters']['Materials'].keys()):
+    materials = parameters.get('Materials',{})
+    for name_enum,name in enumerate(materials.keys()):
         this_id = None
         expected_id = name_enum+1
         if ok_to_guess_ids:
             this_id = expected_id
-        this_dict = merged['Parameters']['Materials'][name]
+        this_dict = materials[name]
         if 'Id' in this_dict:
             this_id = this_dict['Id']
             ok_to_guess_ids = False # No longer allow guessing Ids
             assert this_id not in csv_data['id']
         csv_data['id'].append(this_id)
         csv_data['name'].append(name)
-    to_csv(csv_data,csv_fname)
+    return csv_data
+
+# NRRD type of each numpy dtype of data sections
+nrrd_types = {'uint8':'uint8',
+              'int16':'int16',
+              'uint16':'uint16',
+              'int32':'int32',
+              'float32':'float',
+              'float64':'double',
+              }
+
+def nrrd_header(section, parameters, encoding, fields=()):
+    """the header of an NRRD file holding the data of section
+
+    section is as listed by read_amira_header() and parameters is the
+    Parameters block of the file. The data is kept as stored, so the
+    sizes are x, y, z (after the components, if any) and the endian is
+    that of the file. For uniform lattices the spacing and origin are
+    given by the BoundingBox. fields are more (name, value) lines.
+    """
+    dtype = np.dtype(section['dtype'])
+    sizes = list(section['shape'])
+    components = section['components']
+    if components > 1:
+        sizes = [components] + sizes
+    lines = ['NRRD0004',
+             '# Complete NRRD file format specification at:',
+             '# http://teem.sourceforge.net/nrrd/format.html',
+             'type: %s'%nrrd_types[dtype.name],
+             'dimension: %d'%len(sizes),
+             'sizes: %s'%' '.join('%d'%n for n in sizes),
+             ]
+    bbox = parameters.get('BoundingBox')
+    coord_type = parameters.get('CoordType','"uniform"')
+    shape = section['shape']
+    if coord_type=='"uniform"' and isinstance(bbox,list) and len(bbox)==2*len(shape):
+        directions = []
+        for i, n in enumerate(shape):
+            spacing = (bbox[2*i+1]-bbox[2*i])/(n-1) if n > 1 else 1.0
+            directions.append( '(%s)'%','.join( repr(float(spacing if j==i else 0)) for j in range(len(shape)) ) )
+        if components > 1:
+            directions = ['none'] + directions
+            lines.append( 'kinds: vector%s'%(' domain'*len(shape)) )
+        lines.append( 'space dimension: %d'%len(shape) )
+        lines.append( 'space directions: %s'%' '.join(directions) )
+        lines.append( 'space origin: (%s)'%','.join( repr(float(v)) for v in bbox[0::2] ) )
+    if dtype.itemsize > 1:
+        lines.append( 'endian: %s'%('big' if dtype.byteorder=='>' else 'little') )
+    lines.append( 'encoding: %s'%encoding )
+    for name, value in fields:
+        lines.append( '%s: %s'%(name, value) )
+    return '\n'.join(lines) + '\n'
+
+def read_parameters(header):
+    """the Parameters block of a file from read_amira_header()"""
+    parameters = {}
+    for row in header['data']:
+        if isinstance(row, dict) and 'Parameters' in row:
+            parameters.update(row['Parameters'])
+    return parameters
+
+def lattice_section(header):
+    """the data section to convert, the last one as for convert_file()"""
+    if not header['info'].get('is_binary') or not len(header['sections']):
+        print('Only binary .am files are supported',file=sys.stderr)
+        sys.exit(1)
+    return header['sections'][-1]
+
+GZIP_LEVEL = 9 # as nrrd.write
+
+def convert_file_streaming(fname, csv_fname, nrrd_fname, encoding='gzip', level=GZIP_LEVEL):
+    """convert as convert_file(), but without holding the volume in memory
+
+    The NRRD header is written from the header of the .am file, and the
+    data is then decoded and written (gzip compressed incrementally, if
+    encoding is 'gzip') a chunk at a time.
+    """
+    header = read_amira.read_amira_header( fname )
+    section = lattice_section( header )
+    parameters = read_parameters( header )
+    to_csv( materials_csv_data(parameters), csv_fname )
+
+    with open(fname,mode='rb') as fileobj:
+        with open(nrrd_fname,mode='wb') as fd:
+            fd.write( nrrd_header(section, parameters, encoding).encode('ascii') )
+            fd.write( b'\n' )
+            if encoding=='gzip':
+                compressor = zlib.compressobj( level, zlib.DEFLATED, 16+zlib.MAX_WBITS )
+            for chunk in read_amira.iter_section_data( fileobj, section ):
+                if encoding=='gzip':
+                    chunk = compressor.compress( chunk )
+                fd.write( chunk )
+            if encoding=='gzip':
+                fd.write( compressor.flush() )
+
+def convert_file_detached(fname, csv_fname, nhdr_fname, raw_fname):
+    """write a detached NRRD header for the data of the .am file
+
+    Raw data is not copied: the header's data file is the .am file
+    itself, with a byte skip to the data section. Compressed data is
+    decoded a chunk at a time into raw_fname, which the header then
+    refers to. The materials CSV is written as by convert_file().
+    """
+    header = read_amira.read_amira_header( fname )
+    section = lattice_section( header )
+    parameters = read_parameters( header )
+    to_csv( materials_csv_data(parameters), csv_fname )
+
+    nhdr_dir = os.path.dirname( os.path.abspath(nhdr_fname) )
+    if section['encoding']=='raw':
+        fields = [('byte skip', '%d'%section['offset']),
+                  ('data file', os.path.relpath(os.path.abspath(fname), nhdr_dir))]
+    else:
+        with open(fname,mode='rb') as fileobj:
+            with open(raw_fname,mode='wb') as fd:
+                for chunk in read_amira.iter_section_data( fileobj, section ):
+                    fd.write( chunk )
+        fields = [('data file', os.path.relpath(os.path.abspath(raw_fname), nhdr_dir))]
+    with open(nhdr_fname,mode='w') as fd:
+        # the data file comes last, as the spec requires
+        fd.write( nrrd_header(section, parameters, 'raw', fields=fields) )
+
+def convert_file(fname,csv_fname,nrrd_fname):
+    # nrrd.write stores x fastest, so this layout needs no reordering copy
+    data = read_amira.read_amira( fname, order='xyz-F' )
+    dlist = data['data']
+    merged = {}
+    for row in dlist:
+        merged.update(row)
+    if 'data' not in merged:
+        print('Only binary .am files are supported',file=sys.stderr)
+        sys.exit(1)
+    arr = merged['data']
+    to_csv(materials_csv_data(merged['Parameters']),csv_fname)
     nrrd.write(nrrd_fname, arr)
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('FILE', type=str, help='The file to show')
+    parser.add_argument('--stream', action='store_true',
+                        help='decode and write the data a chunk at a time, using little memory')
+    parser.add_argument('--encoding', type=str, default='gzip', choices=['gzip','raw'],
+                        help='the NRRD encoding of the data with --stream')
+    parser.add_argument('--detached', action='store_true',
+                        help='write a .nhdr header referring to the data in the .am file '
+                        '(or, if compressed, in a decoded .raw file)')
     args = parser.parse_args()
 
     fname = args.FILE
     csv_fname = fname+'.csv'
-    nrrd_fname = fname+'.nrrd'
+    if args.detached:
+        nrrd_fname = fname+'.nhdr'
+    else:
+        nrrd_fname = fname+'.nrrd'
 
-    for test_fname in [csv_fname, nrrd_fname]:
+    out_fnames = [csv_fname, nrrd_fname]
+    if args.detached:
+        out_fnames.append( fname+'.raw' )
+    for test_fname in out_fnames:
         if os.path.exists(test_fname):
             print('ERROR: will not overwrite output file %r'%test_fname, file=sys.stderr)
             sys.exit(1)
 
-    convert_file( fname, csv_fname, nrrd_fname)
+    if args.detached:
+        convert_file_detached( fname, csv_fname, nrrd_fname, fname+'.raw' )
+    elif args.stream:
+        convert_file_streaming( fname, csv_fname, nrrd_fname, encoding=args.encoding )
+    else:
+        convert_file( fname, csv_fname, nrrd_fname)
 
 if __name__=='__main__':
     main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""show where the time goes when reading .am and .surf files
+
+Usage: python -m py_amira_file_reader.profile FILE [FILE ...]
+
+Each file is read with read_amira() while a PhaseTimer observes it, and
+the time spent in each phase (see read_amira.PHASES), not counting the
+phases it contains, is printed with the throughput of the phase. With
+--threads, phases of different threads overlap and can add up to more
+than the total.
+"""
+from __future__ import print_function
+
+import py_amira_file_reader.read_amira as read_amira
+import collections
+import threading
+import time
+import sys
+
+import argparse
+
+class PhaseTimer(read_amira.Observer):
+    """add up the time, bytes and number of calls of each phase
+
+    The time of a phase excludes the phases it contains, so that the
+    times of all phases add up to the time spent reading.
+    """
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.bytes_in = collections.defaultdict(int)
+        self.bytes_out = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        # the phases under way in this thread, with the time each
+        # last started or resumed
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def start(self, phase, section=None):
+        now = time.perf_counter()
+        stack = self._stack()
+        if len(stack):
+            # pause the containing phase
+            outer, resumed = stack[-1]
+            with self._lock:
+                self.seconds[outer] += now - resumed
+        stack.append( [phase, now] )
+
+    def end(self, phase, section=None, bytes_in=None, bytes_out=None):
+        now = time.perf_counter()
+        stack = self._stack()
+        started_phase, resumed = stack.pop()
+        assert started_phase==phase
+        with self._lock:
+            self.seconds[phase] += now - resumed
+            self.calls[phase] += 1
+            if bytes_in is not None:
+                self.bytes_in[phase] += bytes_in
+            if bytes_out is not None:
+                self.bytes_out[phase] += bytes_out
+        if len(stack):
+            stack[-1][1] = now
+
+def print_report(timer, total, fd=sys.stdout):
+    print('%-10s %7s %9s %6s %10s %10s %10s'%(
+        'phase', 'calls', 'seconds', '%', 'MB in', 'MB out', 'MB/s'), file=fd)
+    phases = [p for p in read_amira.PHASES if timer.calls[p]]
+    for phase in phases:
+        seconds = timer.seconds[phase]
+        mb_in = timer.bytes_in[phase]/1e6
+        mb_out = timer.bytes_out[phase]/1e6
+        # throughput of what the phase consumes, or else produces
+        mb = mb_in or mb_out
+        rate = '%10.1f'%(mb/seconds) if mb and seconds > 0 else '%10s'%'-'
+        print('%-10s %7d %9.4f %6.1f %10.2f %10.2f %s'%(
+            phase, timer.calls[phase], seconds, 100.0*seconds/total if total else 0,
+            mb_in, mb_out, rate), file=fd)
+    other = total - sum(timer.seconds[p] for p in phases)
+    print('%-10s %7s %9.4f %6.1f'%('other', '', other, 100.0*other/total if total else 0), file=fd)
+    print('%-10s %7s %9.4f'%('total', '', total), file=fd)
+
+def main():
+    parser = argparse.ArgumentParser(description='show the time spent in each phase of reading files')
+    parser.add_argument('FILE', type=str, nargs='+', help='the .am or .surf files to read')
+    parser.add_argument('--repeat', type=int, default=1, help='read each file this many times')
+    parser.add_argument('--mmap', action='store_true', help='memory map the files')
+    parser.add_argument('--threads', type=int, default=None, help='decode data sections in this many threads')
+    parser.add_argument('--order', type=str, default=None, choices=[o for o in read_amira.ORDERS if o],
+                        help='the memory layout of the data sections')
+    args = parser.parse_args()
+
+    timer = PhaseTimer()
+    read_amira.add_observer(timer)
+    try:
+        t0 = time.perf_counter()
+        for i in range(args.repeat):
+            for fname in args.FILE:
+                read_amira.read_amira(fname, mmap=args.mmap, threads=args.threads, order=args.order)
+        total = time.perf_counter() - t0
+    finally:
+        read_amira.remove_observer(timer)
+    print_report(timer, total)
+
+if __name__=='__main__':
+    main()
@@ -4,14 +4,13 @@ import sys
 import os
 import re
 import numpy as np
-try:
-    # Python 3
-    from io import BytesIO as StringIO
-except ImportError:
-    # Python 2
-    from StringIO import StringIO
 import zlib
+import mmap
 import warnings
+import json
+import hashlib
+import tempfile
+import threading
 
 import collections
 
@@ -36,31 +35,41 @@ dtypes = {'Vertices':np.float32,
       }
 ARRAY_FIELDS = dtypes.keys()
 
-def get_nth_index( buf, seq, n ):
-    """find the index of the nth occurance of seq in buf"""
+# element types of data sections, e.g. "float" in "Lattice { float Data } @1"
+element_dtypes = {'byte':np.uint8,
+                  'short':np.int16,
+                  'ushort':np.uint16,
+                  'int':np.int32,
+                  'float':np.float32,
+                  'double':np.float64,
+                  }
+
+NEWLINE_SEARCH_CHUNK_SIZE = 1024*1024
+
+def find_nth_newline( buf, n, start=0, chunk_size=NEWLINE_SEARCH_CHUNK_SIZE ):
+    """find the index of the nth newline in buf, searching from start
+
+    The search is vectorized with numpy, one chunk of buf at a time.
+    """
     assert n>=1
-    cur_base = 0
-    cur_buf = buf
-    for i in range(n):
-        this_idx = cur_buf.index(seq)
-        idx = cur_base + this_idx
-        cur_base += this_idx+len(seq)
-        cur_buf = cur_buf[this_idx+len(seq):]
-    return idx
-
-def test_get_nth_index_simple():
-    buf = 'abcbdb'
-    assert buf.index( 'b' )==1
-    assert get_nth_index( buf, 'b', 1 )==1
-    assert get_nth_index( buf, 'b', 2 )==3
-    assert get_nth_index( buf, 'b', 3 )==5
-
-def test_get_nth_index_complex():
-    buf = 'aa111bb111cc111'
-    assert buf.index( '111' )==2
-    assert get_nth_index( buf, '111', 1 )==2
-    assert get_nth_index( buf, '111', 2 )==7
-    assert get_nth_index( buf, '111', 3 )==12
+    data = np.frombuffer( buf, dtype=np.uint8 )
+    remaining = n
+    pos = start
+    while pos < len(data):
+        chunk = data[pos:pos+chunk_size]
+        newlines = np.flatnonzero( chunk == ord(b'\n') )
+        if len(newlines) >= remaining:
+            return pos + int(newlines[remaining-1])
+        remaining -= len(newlines)
+        pos += len(chunk)
+    raise ValueError('subsection not found')
+
+def test_find_nth_newline():
+    buf = b'a\nbb\n\nc\n'
+    assert find_nth_newline( buf, 1 )==1
+    assert find_nth_newline( buf, 3 )==5
+    assert find_nth_newline( buf, 2, start=2 )==5
+    assert find_nth_newline( buf, 4, chunk_size=2 )==7
 
 class Matcher:
     def __init__(self,rexp):
@@ -69,23 +78,42 @@ class Matcher:
         matchobj = self.rexp.match( buf )
         return matchobj is not None
 
-re_string_literal = re.compile(br'^".*"$')
-is_string_literal = Matcher(re_string_literal)
-
-re_bytedata_info = re.compile(br'^@(\d+)(\((\w+),(\d+)\))?$')
-is_bytedata_info = Matcher(re_bytedata_info)
-
-re_bytedata_key = re.compile(br'^@(\d+)$')
-is_bytedata_key = Matcher(re_bytedata_key)
-
 # from http://stackoverflow.com/a/12929311/1633026
 re_float = re.compile(br'^[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?$')
 is_number = Matcher(re_float)
 
-re_name = re.compile(br'^[a-zA-Z0-9_]+(\[\d\])?$')
-is_name = Matcher(re_name)
+# all tokens of the header, the kind of token given by the name of the
+# group which matched (the TOKEN_* constants, plus 'bytedata_key' for the
+# "@N" line which starts a data section and 'error' for anything else)
+re_header_token = re.compile(r'''
+      (?P<comment>^[ \t]*\#[^\n]*)
+    | [ \t\r]*
+      (?:
+          (?P<newline>\n)
+        | (?P<string>"[^\n]*")
+        | (?P<op>[{}])
+        | (?P<colon>:)
+        | (?P<equals>=)
+        | (?P<comma>,)
+        | (?P<bytedata_key>^@(?P<key_id>\d+))(?=[\s,]|\Z)
+        | (?P<bytedata_info>@(?P<info_id>\d+)(?:\((?P<info_encoding>\w+),(?P<info_size>\d+)\))?)(?=[\s,]|\Z)
+        | (?P<number>[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)(?=[\s,{}"]|\Z)
+        | (?P<name>[a-zA-Z0-9_]+(?:\[\d\])?)(?=[\s,{}"]|\Z)
+        | (?P<error>[^\s]+)
+      )
+    ''', re.MULTILINE | re.VERBOSE)
+
+# a line after which data may follow: "@N" or e.g. "Vertices 4"
+re_data_start = re.compile(br'^(?:@\d+|[ \t]*(?:%s)[ \t]+\d+)[ \t\r]*(?:\n|\Z)'%(
+    '|'.join(sorted(dtypes.keys())).encode("utf-8"),), re.MULTILINE)
+
+re_element_type = re.compile(r'^(\w+)(\[(\d+)\])?$')
+
+# e.g. "nNodes 16", the old way of giving the number of Nodes
+re_count_name = re.compile(r'^n([A-Z]\w*)$')
 
-re_quoted_whitespace_splitter = re.compile(br'(".*")|[ \t\n]')
+# the "@N" line which starts a data section, with any blank lines before it
+re_section_start = re.compile(br'\s*@(\d+)[ \t\r]*\n')
 
 def lim_repr(value):
     full = repr(value)
@@ -93,243 +121,969 @@ def lim_repr(value):
         full = full[:97]+'...'
     return full
 
+RLE_CHUNK_SIZE = 4*1024*1024 # bytes of output expanded at a time
+RLE_WINDOW_SIZE = 64*1024 # bytes of encoded data parsed at a time
+
+def find_rle_literals(buf):
+    """locate the literal blocks at the start of HxByteRLE data
+
+    Each control byte c is followed either by one byte repeated c times
+    (c < 128) or by c-128 literal bytes. Within a stretch of repeats
+    the control bytes are every other byte, so only the bytes which
+    can end such a stretch (0 or >= 128) are candidates for the other
+    control bytes. Each candidate points to the first candidate of the
+    same parity after its block, and the chain of candidates starting
+    at the first byte is followed by pointer jumping, without a Python
+    loop over the blocks.
+
+    Returns the positions of the literal control bytes, the number of
+    bytes of buf covered by complete blocks (a block cut off at the end
+    of buf is left out) and whether a zero control byte ended the data.
+    """
+    data = np.frombuffer( buf, dtype=np.uint8 )
+    n = len(data)
+    candidates = np.flatnonzero( data.view(np.int8) <= 0 )
+    n_candidates = len(candidates) # also the index meaning "none"
+    candidate_bytes = data[candidates].astype(np.intp)
+    # where the block after each candidate would start (past the end
+    # for a zero control byte, which ends the data)
+    block_stops = np.where( candidate_bytes==0, n+1, candidates+candidate_bytes-127 )
+
+    # the index of the first candidate of the same parity at or after
+    # where each block ends, and where the first block starts
+    goes_on = block_stops < n
+    targets = np.append( block_stops[goes_on], 0 )
+    if n_candidates < n//16:
+        # few candidates: look them up among those of the same parity
+        found = np.empty( len(targets), dtype=np.intp )
+        for r in (0,1):
+            indices = np.flatnonzero( (candidates & 1)==r )
+            sel = (targets & 1)==r
+            found[sel] = np.append( indices, n_candidates )[
+                np.searchsorted( candidates[indices], targets[sel] )]
+    else:
+        # a table of the next candidate for every byte
+        next_candidate = np.full( n+2, n_candidates, dtype=np.intp )
+        next_candidate[candidates] = np.arange( n_candidates )
+        for r in (0,1):
+            reverse = next_candidate[r::2][::-1]
+            np.minimum.accumulate( reverse, out=reverse )
+        found = next_candidate[targets]
+
+    jumps = np.full( n_candidates+1, n_candidates, dtype=np.intp )
+    jumps[:-1][goes_on] = found[:-1]
+    first = found[-1:]
+    # jumps_list[i] skips 2**i candidates, far enough to pass the end
+    # of the chain from first
+    jumps_list = [jumps]
+    while jumps[first[0]] != n_candidates:
+        jumps = jumps[jumps]
+        jumps_list.append( jumps )
+    chain = first[first < n_candidates]
+    for jumps in reversed( jumps_list ):
+        chain = np.concatenate( (chain, jumps[chain]) )
+        chain = chain[chain < n_candidates]
+    chain.sort()
+
+    literals = candidates[chain]
+    ended = False
+    if len(chain) and block_stops[chain[-1]] > n:
+        # the data ends with a zero, or the last block is cut off
+        ended = bool(candidate_bytes[chain[-1]]==0)
+        literals = literals[:-1]
+        consumed = int(candidates[chain[-1]])
+    else:
+        # repeats to the end, up to a pair cut off
+        start = int(block_stops[chain[-1]]) if len(chain) else 0
+        consumed = start + 2*((n-start)//2)
+    return literals, consumed, ended
+
+def iter_windows( buf, window_size=RLE_WINDOW_SIZE ):
+    """yield buf in slices of window_size bytes"""
+    buf = memoryview(buf)
+    for pos in range(0, len(buf), window_size):
+        yield buf[pos:pos+window_size]
+
+def iter_file_windows( fileobj, size, window_size=RLE_WINDOW_SIZE ):
+    """yield the next size bytes of fileobj, read window_size bytes at a time"""
+    n_read = 0
+    while n_read < size:
+        window = fileobj.read( min(window_size, size-n_read) )
+        if not len(window):
+            break
+        n_read += len(window)
+        yield window
+
+def iter_rle_decompress( windows, start=0, stop=None, chunk_size=RLE_CHUNK_SIZE ):
+    """yield the decoded bytes start:stop of HxByteRLE data as uint8 arrays
+
+    The encoded data is given as an iterable of windows, e.g. from
+    iter_windows() or read from a file, and parsed one window at a
+    time, a block cut off at the end of a window being carried over to
+    the next. So besides about a window of encoded data and its index,
+    only pieces of at most about chunk_size bytes of output are held.
+    """
+    tail = b''
+    pos = 0 # decoded offset of the first block of the window
+    ended = False
+    for window in windows:
+        if len(tail):
+            window = b''.join( (tail, window) )
+        blocks = RLEBlocks( window )
+        lo = max( start-pos, 0 )
+        hi = blocks.total if stop is None else min( stop-pos, blocks.total )
+        if hi > lo:
+            for piece in blocks.expand( lo, hi, chunk_size=chunk_size ):
+                yield piece
+        pos += blocks.total
+        tail = bytes( memoryview(window)[blocks.consumed:] )
+        ended = blocks.ended
+        if ended or (stop is not None and pos >= stop):
+            break
+    else:
+        if len(tail):
+            raise ValueError('HxByteRLE data is truncated')
+    if stop is not None and pos < stop:
+        raise ValueError('cannot decode bytes %d:%d of %d bytes of HxByteRLE data'%(start,stop,pos))
+
+def rle_decompress_into(buf, out=None, chunk_size=RLE_CHUNK_SIZE, start=0, stop=None):
+    """decode HxByteRLE data from buf into the array out
+
+    If out is None, a new uint8 array of the decoded size is returned.
+    Otherwise out must be C contiguous and of exactly the decoded size.
+    Runs and literal blocks are expanded with bulk array operations,
+    a window of encoded data and chunk_size bytes of output at a time.
+
+    If start or stop are given, only the bytes start:stop of the decoded
+    data are expanded into out.
+    """
+    pieces = iter_rle_decompress( iter_windows(buf), start=start, stop=stop,
+                                  chunk_size=chunk_size )
+    if out is None:
+        if stop is None:
+            # the size is only known once decoded
+            pieces = list(pieces)
+            return np.concatenate( [np.empty(0, dtype=np.uint8)] + pieces )
+        out = np.empty( stop-start, dtype=np.uint8 )
+    out_flat = out.reshape(-1).view(np.uint8)
+    pos = 0
+    for piece in pieces:
+        if pos + len(piece) > len(out_flat):
+            raise ValueError('HxByteRLE data decodes to more than the expected %d bytes'%len(out_flat))
+        out_flat[pos:pos+len(piece)] = piece
+        pos += len(piece)
+    if pos != len(out_flat):
+        raise ValueError('HxByteRLE data decodes to %d bytes, expected %d'%(pos,len(out_flat)))
+    return out
+
+class RLEBlocks:
+    """the complete blocks at the start of a window of HxByteRLE data
+
+    Each byte of the window is weighted by the number of times it
+    occurs in the decoded data: 0 for control bytes, the count for the
+    byte of a run and 1 for the bytes of a literal block, so that
+    np.repeat() expands any range of them. consumed is the number of
+    bytes of the window the blocks cover, ended whether the data ended
+    with a zero control byte.
+    """
+    def __init__( self, buf ):
+        literals, self.consumed, self.ended = find_rle_literals( buf )
+        data = np.frombuffer( buf, dtype=np.uint8 )[:self.consumed]
+        n = len(data)
+        # the window alternates between stretches of runs and literal
+        # blocks, which both may be empty
+        bounds = np.empty( 2*len(literals)+2, dtype=np.intp )
+        bounds[0] = 0
+        bounds[1:-1:2] = literals
+        bounds[2:-1:2] = literals + data[literals] - 127
+        bounds[-1] = n
+        # 0 or 1 for runs with control bytes at even or odd positions,
+        # 2 for literal blocks
+        kinds = np.empty( len(bounds)-1, dtype=np.uint8 )
+        kinds[0::2] = bounds[0:-1:2] & 1
+        kinds[1::2] = 2
+        kind = np.repeat( kinds, np.diff(bounds) )
+        parity = np.empty( n, dtype=np.uint8 )
+        parity[0::2] = 0
+        parity[1::2] = 1
+        counts = np.empty( n, dtype=np.uint8 )
+        counts[:1] = 0
+        counts[1:] = data[:-1]
+        weights = np.where( kind==parity, np.uint8(0), counts )
+        weights[kind==2] = 1
+        weights[literals] = 0
+        self.data = data
+        self.weights = weights
+        self.total = int(weights.sum( dtype=np.intp ))
+
+    def check_range( self, start, stop ):
+        if not 0 <= start <= stop <= self.total:
+            raise ValueError('cannot decode bytes %d:%d of %d bytes of HxByteRLE data'%(start,stop,self.total))
+
+    def expand( self, start=0, stop=None, chunk_size=RLE_CHUNK_SIZE ):
+        """yield the decoded bytes start:stop as uint8 arrays of about chunk_size bytes"""
+        if stop is None:
+            stop = self.total
+        self.check_range( start, stop )
+        data, weights = self.data, self.weights
+        if start==0 and stop==self.total and stop<=chunk_size:
+            if stop:
+                yield np.repeat( data, weights )
+            return
+        ends = np.cumsum( weights, dtype=np.intp )
+        pos = start
+        while pos < stop:
+            piece_stop = min( pos+chunk_size, stop )
+            # the bytes whose runs overlap pos:piece_stop
+            first = int(np.searchsorted( ends, pos, side='right' ))
+            last = int(np.searchsorted( ends, piece_stop, side='left' ))+1
+            piece = np.repeat( data[first:last], weights[first:last] )
+            offset = int(ends[first]) - int(weights[first])
+            yield piece[pos-offset:piece_stop-offset]
+            pos = piece_stop
+
 def rle_decompress(buf):
-    result = []
-    idx = 0
-    buflen = len(buf)
-    while idx < buflen:
-        control_byte = ord(buf[idx:idx+1])
-        idx += 1
-        if control_byte==0:
+    """decode HxByteRLE data, returning bytes"""
+    return rle_decompress_into(buf).tobytes()
+
+ZLIB_CHUNK_SIZE = 1024*1024 # bytes of output decompressed at a time
+
+def zlib_decompress_into( buf, out, chunk_size=ZLIB_CHUNK_SIZE ):
+    """decompress the zlib stream in buf into the preallocated array out
+
+    The input is fed and the output produced chunk_size bytes at a time,
+    so besides out only about one chunk is held in memory. A ValueError
+    is raised unless the stream decompresses to exactly out.nbytes.
+    """
+    out_bytes = memoryview(out.reshape(-1).view(np.uint8))
+    n_total = len(out_bytes)
+    data = memoryview(buf)
+    n_in = len(data)
+    decompressor = zlib.decompressobj()
+    pos = 0
+    n_out = 0
+    tail = b''
+    while not decompressor.eof:
+        if len(tail):
+            chunk_in = tail
+        elif pos < n_in:
+            chunk_in = data[pos:pos+chunk_size]
+            pos += len(chunk_in)
+        else:
             break
-        elif control_byte <= 127:
-            repeats = control_byte
-            new_byte = buf[idx:idx+1]
-            idx += 1
-            result.append( new_byte*repeats )
+        chunk = decompressor.decompress( chunk_in, chunk_size )
+        tail = decompressor.unconsumed_tail
+        if n_out + len(chunk) > n_total:
+            raise ValueError('zlib data decompresses to more than the expected %d bytes'%n_total)
+        out_bytes[n_out:n_out+len(chunk)] = chunk
+        n_out += len(chunk)
+    chunk = decompressor.flush()
+    if n_out + len(chunk) > n_total:
+        raise ValueError('zlib data decompresses to more than the expected %d bytes'%n_total)
+    out_bytes[n_out:n_out+len(chunk)] = chunk
+    n_out += len(chunk)
+    if not decompressor.eof:
+        raise ValueError('zlib data is truncated after %d of %d bytes'%(n_out,n_total))
+    if n_out != n_total:
+        raise ValueError('zlib data decompresses to %d bytes, expected %d'%(n_out,n_total))
+    return out
+
+def zlib_decompress_range( fileobj, size, start, stop, chunk_size=ZLIB_CHUNK_SIZE ):
+    """decompress bytes start:stop of a zlib stream read from fileobj
+
+    The stream is size bytes long and starts at the current position of
+    fileobj. It is read and decompressed chunk_size bytes at a time,
+    output before start is discarded and reading ends at stop. Returns
+    a uint8 array.
+    """
+    out = np.empty( stop-start, dtype=np.uint8 )
+    decompressor = zlib.decompressobj()
+    n_read = 0
+    pos = 0
+    tail = b''
+    while pos < stop and not decompressor.eof:
+        if len(tail):
+            chunk_in = tail
+        elif n_read < size:
+            chunk_in = fileobj.read( min(chunk_size, size-n_read) )
+            if not len(chunk_in):
+                break
+            n_read += len(chunk_in)
         else:
-            num_bytes = control_byte-128
-            new_bytes = buf[idx:idx+num_bytes]
-            idx += num_bytes
-            result.append( new_bytes )
-    final_result = b''.join(result)
-    return final_result
+            chunk = decompressor.flush()
+            chunk_in = None
+        if chunk_in is not None:
+            chunk = decompressor.decompress( chunk_in, chunk_size )
+            tail = decompressor.unconsumed_tail
+        lo = max( pos, start )
+        hi = min( pos+len(chunk), stop )
+        if hi > lo:
+            out[lo-start:hi-start] = np.frombuffer( chunk, dtype=np.uint8 )[lo-pos:hi-pos]
+        pos += len(chunk)
+        if chunk_in is None:
+            break
+    if pos < stop:
+        raise ValueError('zlib data is truncated after %d of %d bytes'%(pos,stop))
+    return out
+
+def read_buffer(fileobj, max_bytes=None):
+    """read the remainder of fileobj into a single mutable buffer
+
+    Where the size is known up front, the data is read directly into a
+    preallocated bytearray so that it is held in memory only once. At
+    most max_bytes are read, if given.
+    """
+    try:
+        size = os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except (AttributeError, OSError, ValueError):
+        size = None
+    if size is None or size < 0:
+        return bytearray(fileobj.read(-1 if max_bytes is None else max_bytes))
+    if max_bytes is not None:
+        size = min(size, max_bytes)
+    buf = bytearray(size)
+    view = memoryview(buf)
+    n_read = 0
+    while n_read < size:
+        n = fileobj.readinto(view[n_read:])
+        if not n:
+            break
+        n_read += n
+    view.release()
+    if n_read < size:
+        del buf[n_read:]
+    return buf
+
+def map_buffer(fileobj):
+    """memory map the file behind fileobj read-only"""
+    fileobj.seek(0)
+    if os.fstat(fileobj.fileno()).st_size == 0:
+        # zero-length files cannot be mapped
+        return bytearray()
+    return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+class Token:
+    """a token: its kind (one of the TOKEN_* constants), value and position
+
+    start and end are the offsets of the token in the file buffer.
+    """
+    __slots__ = ('kind', 'value', 'start', 'end')
+
+    def __init__( self, kind, value, start, end ):
+        self.kind = kind
+        self.value = value
+        self.start = start
+        self.end = end
+
+    def __repr__( self ):
+        return 'Token(%r, %s, %r, %r)'%(self.kind, lim_repr(self.value), self.start, self.end)
 
 class Tokenizer:
-    def __init__( self, fileobj ):
-        self.buf = fileobj.read()
+    """split an Amira file into tokens
+
+    The whole file is held in a single buffer, which is only modified
+    with ``native=True`` (see below). Tokenization advances the cursor ``self.pos`` through it, and data
+    sections are handed to the decoders as ``memoryview`` slices, so no
+    bytes are copied until they are decoded.
+
+    With ``use_mmap=True`` the buffer is a read-only memory map of the
+    file, so raw data sections become views straight into the file.
+
+    With ``header_only=True`` tokenization ends at the first data
+    section, and only max_bytes of the file are read (if given).
+
+    With ``lazy=True`` data sections are skipped over and returned as
+    LazyArray instances, which read and decode them when first used.
+
+    The memory layout of decoded data sections is given by order, see
+    ORDERS.
+
+    With ``native=True`` binary data is converted to the native byte
+    order of this machine, otherwise it keeps the byte order of the file.
+    Raw data sections and HyperSurface Vertices and Triangles, which are
+    views of the buffer, are then byteswapped in place in the buffer
+    (unless it is a read-only memory map, see to_native()).
+
+    If an executor (such as a concurrent.futures.ThreadPoolExecutor) is
+    given, data sections are decoded by it while tokenizing continues,
+    and returned as futures of the decoded arrays.
+    """
+    def __init__( self, fileobj, use_mmap=False, header_only=False, max_bytes=None, lazy=False, order=None, executor=None, native=False ):
+        if order not in ORDERS:
+            raise ValueError('order must be one of %r, not %r'%(ORDERS,order))
+        self.use_mmap = use_mmap
+        self.lazy = lazy
+        self.order = order
+        self.executor = executor
+        self.native = native
+        self.filename = None
+        if lazy:
+            self.filename = getattr(fileobj,'name',None)
+            if not isinstance(self.filename,(str,bytes,os.PathLike)):
+                raise ValueError('lazy loading requires a file opened by name')
+        if observers:
+            notify_start( 'read' )
+        if use_mmap or lazy:
+            # when lazy, only the pages with the header and the section
+            # boundaries are ever read from disk
+            self.buf = map_buffer(fileobj)
+        else:
+            self.buf = read_buffer(fileobj, max_bytes=max_bytes)
+        if observers:
+            notify_end( 'read', bytes_out=len(self.buf) )
+        # whether the end of the buffer is not the end of the file
+        self.truncated = (max_bytes is not None and len(self.buf)==max_bytes and
+                          len(fileobj.read(1))==1)
+        self.view = memoryview(self.buf)
+        self.pos = 0
+        self.header_only = header_only
+        self.reached_data = False
         self.last_tokens = []
         self.file_info = {}
-        self._bytedata = {}
+        self._bytedata = collections.OrderedDict()
         self.defines = {}
+        self.debug = is_debug()
     def add_defines(self, define_dict ):
         self.defines.update(define_dict)
+    def _declare_section( self, decl_parts, bytedata_id, encoding, size ):
+        """describe the data section declared as e.g. ``Lattice { byte Data } @1``"""
+        section = {'id':int(bytedata_id),
+                   'location':None,
+                   'name':None,
+                   'type':None,
+                   'components':1,
+                   'dtype':None,
+                   'shape':None,
+                   'encoding':None,
+                   'offset':None,
+                   'size':None,
+                   }
+        if encoding is not None:
+            section['encoding'] = encoding
+            section['size'] = int(size)
+        if len(decl_parts) >= 4 and decl_parts[1]=='{':
+            section['location'] = decl_parts[0]
+            matchobj = re_element_type.match( decl_parts[2] )
+            if matchobj is not None:
+                element_type, _, components = matchobj.groups()
+                section['type'] = element_type
+                if components is not None:
+                    section['components'] = int(components)
+            section['name'] = decl_parts[3]
+        return section
+    def _finish_section( self, section ):
+        """fill in the shape and encoding of section from the defines"""
+        if section['shape'] is None:
+            dim = self.defines.get(section['location'],None)
+            if dim is None and len(self.defines)==1:
+                for key in self.defines:
+                    dim = self.defines[key]
+            if isinstance(dim,list):
+                section['shape'] = tuple(dim)
+            elif dim is not None:
+                section['shape'] = (dim,)
+        if section['dtype'] is None:
+            if self.file_info.get('is_binary',BINARY_DEFAULT):
+                byte_order = self.file_info.get('byte_order','big')
+            else:
+                # ASCII data is parsed to native byte order
+                byte_order = sys.byteorder
+            section['dtype'] = element_dtype( section['type'], byte_order ).str
+        if section['encoding'] is None:
+            if self.file_info.get('is_binary',BINARY_DEFAULT):
+                section['encoding'] = 'raw'
+                section['size'] = int(np.prod( section_shape(section) ))*np.dtype(section['dtype']).itemsize
+            else:
+                section['encoding'] = 'ascii'
+    def get_sections( self ):
+        """return the table of all declared data sections, ordered by id"""
+        sections = list(self._bytedata.values())
+        for section in sections:
+            if section['offset'] is None:
+                self._finish_section(section)
+        sections.sort(key=lambda section: section['id'])
+        return sections
     def get_tokens( self ):
-        # keep a running accumulation of last 2 tokens
+        # keep a running accumulation of last 3 tokens
         for token_enum,token in enumerate(self._get_tokens()):
             self.last_tokens.append( token )
-            while len(self.last_tokens) > 3:
-                self.last_tokens.pop(0)
+            if len(self.last_tokens) > 3:
+                del self.last_tokens[0]
             if token_enum==0:
-                if token[0] == TOKEN_COMMENT and token[1]=='# HyperSurface 0.1 BINARY':
+                if token.kind == TOKEN_COMMENT and token.value=='# HyperSurface 0.1 BINARY':
                     self.file_info = {'type':'HyperSurface',
                                       'version':'0.1',
-                                      'is_binary':True}
-                elif token[0] == TOKEN_COMMENT and token[1]=='# HyperSurface 0.1 ASCII':
+                                      'is_binary':True,
+                                      'byte_order':'big'}
+                elif token.kind == TOKEN_COMMENT and token.value=='# HyperSurface 0.1 ASCII':
                     self.file_info = {'type':'HyperSurface',
                                       'version':'0.1',
                                       'is_binary':False}
-                elif token[0] == TOKEN_COMMENT and token[1]=='# AmiraMesh 3D BINARY 2.0':
+                elif token.kind == TOKEN_COMMENT and token.value=='# AmiraMesh 3D BINARY 2.0':
                     self.file_info = {'type':'AmiraMesh',
                                       'version':'2.0',
-                                      'is_binary':True}
-                elif token[0] == TOKEN_COMMENT and token[1]=='# AmiraMesh 3D BINARY-LITTLE-ENDIAN 2.0':
+                                      'is_binary':True,
+                                      'byte_order':'big'}
+                elif token.kind == TOKEN_COMMENT and token.value=='# AmiraMesh 3D BINARY-LITTLE-ENDIAN 2.0':
                     self.file_info = {'type':'AmiraMesh',
                                       'version':'2.0',
-                                      'is_binary':True}
-                elif token[0] == TOKEN_COMMENT and token[1]=='# AmiraMesh 3D ASCII 2.0':
+                                      'is_binary':True,
+                                      'byte_order':'little'}
+                elif token.kind == TOKEN_COMMENT and token.value=='# AmiraMesh 3D ASCII 2.0':
                     self.file_info = {'type':'AmiraMesh',
                                       'version':'2.0',
                                       'is_binary':False}
-                elif token[0] == TOKEN_COMMENT and token[1]=='# AmiraMesh BINARY-LITTLE-ENDIAN 2.1':
+                elif token.kind == TOKEN_COMMENT and token.value=='# AmiraMesh BINARY-LITTLE-ENDIAN 2.1':
                     self.file_info = {'type':'AmiraMesh',
                                       'version':'2.1',
-                                      'is_binary':True}
+                                      'is_binary':True,
+                                      'byte_order':'little'}
                 else:
                     warnings.warn('Unknown file type. Parsing may fail.')
             yield token
+    def _tokenize( self, text, offset ):
+        """split the header text, found at offset in the buffer, into tokens
+
+        The tokens are returned as the lists of their kinds, values and
+        start and end offsets in the buffer, which unlike a list of
+        Token instances are not tracked by the garbage collector. Data
+        sections are declared as they are met. The "@N" key which starts
+        a data section is left as a 'bytedata_key' token.
+        """
+        kinds, values, starts, ends = [], [], [], []
+        # offsets in text are offsets in the buffer only for ASCII text,
+        # otherwise count the bytes since the last token
+        is_ascii = len(text)==len(text.encode("utf-8"))
+        char_offset = byte_offset = 0
+        for matchobj in re_header_token.finditer( text ):
+            kind = matchobj.lastgroup
+            value = matchobj.group(kind)
+            start, end = matchobj.span(kind)
+            if not is_ascii:
+                byte_offset += len(text[char_offset:start].encode("utf-8"))
+                char_offset = start
+                start = byte_offset
+                end = start + len(value.encode("utf-8"))
+            if kind==TOKEN_BYTEDATA_INFO:
+                # declared by the tokens before it on the line
+                line_start = len(kinds)
+                while line_start > 0 and kinds[line_start-1] != TOKEN_NEWLINE:
+                    line_start -= 1
+                bytedata_id, encoding, size = matchobj.group('info_id', 'info_encoding', 'info_size')
+                self._bytedata[bytedata_id]=self._declare_section(
+                    values[line_start:], bytedata_id, encoding, size )
+            elif kind=='bytedata_key':
+                value = matchobj.group('key_id')
+            elif kind=='error':
+                line_start = text.rfind('\n', 0, matchobj.start(kind))+1
+                line_end = text.find('\n', line_start)
+                raise NotImplementedError( 'cannot tokenize part %r (line %r)'%(
+                    lim_repr(value), lim_repr(text[line_start:line_end if line_end>=0 else None])) )
+            kinds.append( kind )
+            values.append( value )
+            starts.append( offset+start )
+            ends.append( offset+end )
+        return kinds, values, starts, ends
+
     def _get_tokens( self ):
-        newline = b'\n'
-        lineno = 0
-        while len(self.buf) > 0:
+        buflen = len(self.buf)
+        while self.pos < buflen:
 
             if (len(self.last_tokens)>=3 and
-                self.last_tokens[-3][0]==TOKEN_NAME and
-                self.last_tokens[-3][1] in ARRAY_FIELDS and
-                self.last_tokens[-2][0]==TOKEN_NUMBER and
-                self.last_tokens[-1][0]==TOKEN_NEWLINE):
+                self.last_tokens[-3].kind==TOKEN_NAME and
+                self.last_tokens[-3].value in ARRAY_FIELDS and
+                self.last_tokens[-2].kind==TOKEN_NUMBER and
+                self.last_tokens[-1].kind==TOKEN_NEWLINE):
+
+                n_elements = int(self.last_tokens[-2].value)
+                dtype = dtypes[self.last_tokens[-3].value]
+                start = self.pos
 
-                n_elements = int(self.last_tokens[-2][1])
+                if self.header_only:
+                    # no data in the header
+                    self.reached_data = True
+                    yield Token( TOKEN_Vec3Array, None, start, start )
+                    break
 
                 if self.file_info['type']=='HyperSurface':
                     if self.file_info.get('is_binary',BINARY_DEFAULT):
                         sizeof_element = 3*4 # 3x floats, 4 bytes per float
                         n_bytes = n_elements * sizeof_element
 
-                        this_line, self.buf = self.buf[:n_bytes], self.buf[n_bytes:]
-                        lineno += 1
+                        this_line = self.view[self.pos:self.pos+n_bytes]
+                        self.pos += n_bytes
 
                         assert len(this_line)==n_bytes
 
-                        this_data = parse_binary_data(this_line,dtypes[self.last_tokens[-3][1]])
-                        yield ( TOKEN_Vec3Array, this_data, (lineno,0), (lineno, n_bytes), this_line )
+                        if observers:
+                            notify_start( 'vertices' )
+                        this_data = parse_binary_data(this_line,dtype,
+                                                      self.file_info.get('byte_order','big'))
+                        if self.native:
+                            this_data = to_native(this_data)
+                        if observers:
+                            notify_end( 'vertices', bytes_in=n_bytes, bytes_out=this_data.nbytes )
                     else:
-                        idx = get_nth_index( self.buf, newline, n_elements )
-                        this_line, self.buf = self.buf[:idx], self.buf[idx:]
-                        lineno += n_elements
+                        if n_elements:
+                            idx = find_nth_newline( self.view, n_elements, start=self.pos )
+                        else:
+                            idx = self.pos
+                        this_line = self.view[self.pos:idx]
+                        self.pos = idx
 
-                        this_data = parse_ascii_data(this_line)
-                        yield ( TOKEN_Vec3Array, this_data, (lineno-n_elements,0), (lineno, None), this_line )
+                        if observers:
+                            notify_start( 'vertices' )
+                        this_data = parse_ascii_data(this_line,dtype)
+                        if observers:
+                            notify_end( 'vertices', bytes_in=len(this_line), bytes_out=this_data.nbytes )
+                    yield Token( TOKEN_Vec3Array, this_data, start, self.pos )
                 else:
                     raise NotImplementedError
                 continue
 
-            # get the next line -------
-            idx = self.buf.index(newline)+1
-            this_line, self.buf = self.buf[:idx], self.buf[idx:]
-            lineno += 1
-
-            # now parse the line into tokens ----
-            if this_line.lstrip().startswith(b'#'):
-                yield ( TOKEN_COMMENT, this_line[:-1].decode("utf-8"), (lineno,0), (lineno, len(this_line)-1), this_line )
-                yield ( TOKEN_NEWLINE, this_line[-1:].decode("utf-8"), (lineno,len(this_line)-1), (lineno, len(this_line)), this_line )
-            elif this_line==newline:
-                yield ( TOKEN_NEWLINE, this_line.decode("utf-8"), (lineno,0), (lineno, 1), this_line )
+            # the header text up to where data may follow -------
+            matchobj = re_data_start.search( self.buf, self.pos )
+            if (matchobj is not None and self.truncated and
+                not matchobj.group().endswith(b'\n')):
+                # the line ends at the end of the buffer, but may go on
+                # in the file, so where the data starts is not known yet
+                matchobj = None
+            if matchobj is not None:
+                end = matchobj.end()
+            elif self.truncated:
+                # leave out the last line, which may be cut off
+                end = max( self.buf.rfind(b'\n', self.pos)+1, self.pos )
+                if end==self.pos:
+                    break
             else:
-                parts = re_quoted_whitespace_splitter.split(this_line)
-                parts.append(newline) # append newline
-                parts = [p for p in parts if p is not None and len(p)]
-
-                maybe_comma_part_idx = len(parts)-2 if len(parts) >= 2 else None
-
-                colno = 0
-                for part_idx, part in enumerate(parts):
-                    startcol = colno
-                    endcol = len(part)+startcol
-                    colno = endcol + 1
-
-                    if part_idx == maybe_comma_part_idx:
-                        if len(part) > 1 and part.endswith(b','):
-                            # Remove the comma from further processing
-                            part = part[:-1]
-                            endcol -= 1
-                            # Emit a comma token.
-                            yield ( TOKEN_COMMA, part.decode("utf-8"), (lineno,endcol), (lineno, endcol+1), this_line )
-
-                    if part in [b'{',b'}']:
-                        yield ( TOKEN_OP, part.decode("utf-8"), (lineno,startcol), (lineno, endcol), this_line )
-                    elif part==newline:
-                        yield ( TOKEN_NEWLINE, part.decode("utf-8"), (lineno,startcol-1), (lineno, endcol-1), this_line )
-                    elif part==b':':
-                        yield ( TOKEN_COLON, part.decode("utf-8"), (lineno,startcol-1), (lineno, endcol-1), this_line )
-                    elif part==b'=':
-                        yield ( TOKEN_EQUALS, part.decode("utf-8"), (lineno,startcol-1), (lineno, endcol-1), this_line )
-                    elif part==b',':
-                        yield ( TOKEN_COMMA, part.decode("utf-8"), (lineno,startcol-1), (lineno, endcol-1), this_line )
-                    elif is_number(part):
-                        yield ( TOKEN_NUMBER, part.decode("utf-8"), (lineno,startcol), (lineno, endcol), this_line )
-                    elif is_name(part):
-                        yield ( TOKEN_NAME, part.decode("utf-8"), (lineno,startcol), (lineno, endcol), this_line )
-                    elif is_string_literal(part):
-                        yield ( TOKEN_STRING, part.decode("utf-8"), (lineno,startcol), (lineno, endcol), this_line )
-                    elif is_bytedata_info(part) and startcol != 0:
-                        # bytedata_info will not start at beginning of line
-                        matchobj = re_bytedata_info.match( part )
-                        bytedata_id, enc_size, encoding, size = matchobj.groups()
-                        if enc_size is not None:
-                            esdict = {'encoding':encoding.decode("utf-8"),'size':int(size)}
-                        else:
-                            esdict = None
-                        self._bytedata[bytedata_id]=esdict
-                        yield (  TOKEN_BYTEDATA_INFO, part.decode("utf-8"),  (lineno,startcol), (lineno, endcol), this_line )
-                    elif is_bytedata_key(part):
-
-                        matchobj = re_bytedata_key.match( part )
-                        bytedata_id = matchobj.groups()[0]
-                        info = self._bytedata[bytedata_id]
-                        if info is not None:
-                            encoding = info['encoding']
-                            size = info['size']
-                        else:
-                            assert len(self.defines.keys())==1
-                            for key in self.defines:
-                                dim = self.defines[key]
-                                break
-                            if self.file_info.get('is_binary',BINARY_DEFAULT):
-                                encoding='raw'
-                                assert len(dim)==3
-                                size=dim[0]*dim[1]*dim[2]
-                            else:
-                                size = None
-                        shape = self.defines.get('Lattice',None)
-
-                        if self.file_info.get('is_binary',BINARY_DEFAULT):
-                            binary_buf, self.buf = self.buf[:size], self.buf[size:]
-
-                            if encoding=='raw':
-                                raw_buf = binary_buf
-                            elif encoding=='HxZip':
-                                raw_buf = zlib.decompress(binary_buf)
-                            elif encoding=='HxByteRLE':
-                                raw_buf = rle_decompress(binary_buf)
-                            else:
-                                raise ValueError('unknown encoding %r'%encoding)
-
-                            arr = np.fromstring( raw_buf, dtype=np.uint8 )
-                            arr.shape = shape[2], shape[1], shape[0]
-                            arr = np.swapaxes(arr, 0, 2)
-                        else:
-                            # ascii encoded file
-                            raw_buf = []
-                            line_idx = 0
-                            while 1:
-                                lsize = self.buf.index(b'\n')+1
-                                lbuf, self.buf = self.buf[:lsize], self.buf[lsize:]
-                                lbuf = lbuf.strip()
-                                if lbuf==b'':
-                                    # done with this section
-                                    break
-                                elements = []
-                                for el in lbuf.strip().split():
-                                    try:
-                                        r = int(el)
-                                    except ValueError as err:
-                                        r = float(el)
-                                    elements.append(r)
-
-                                raw_buf.append( elements )
-                                line_idx += 1
-                            arr = np.array(raw_buf)
-
-                        yield (  TOKEN_BYTEDATA, {'data':arr},  (lineno,startcol), (lineno, endcol), this_line )
-                    else:
-                        raise NotImplementedError( 'cannot tokenize part %r (line %r)'%(lim_repr(part), lim_repr(this_line)) )
-        yield ( TOKEN_ENDMARKER, '', (lineno,0), (lineno, 0), '' )
-
-def parse_ascii_data(buf):
-    s = StringIO(buf)
-    return np.genfromtxt(s,dtype=None)
-
-def parse_binary_data(buf,dtype):
-    n_bytes = len(buf)
-    n_elements = n_bytes//4 # 4 bytes per float/int32
-    n_vectors = n_elements//3 # 3 elements per vector
-    result = np.fromstring(buf, dtype=dtype)
-    result.shape = (n_vectors, 3)
-    if sys.byteorder=='little':
-        result = result.byteswap()
+                end = buflen
+            if observers:
+                notify_start( 'tokenize' )
+            text = bytes(self.view[self.pos:end]).decode("utf-8")
+            kinds, values, starts, ends = self._tokenize( text, self.pos )
+            if observers:
+                notify_end( 'tokenize', bytes_in=end-self.pos )
+            self.pos = end
+
+            for token in map( Token, kinds, values, starts, ends ):
+                if token.kind!='bytedata_key':
+                    yield token
+                    continue
+                section = self._bytedata[token.value]
+                self._finish_section(section)
+                # the key is on the last line of the text, the data
+                # starts right after it
+                section['offset'] = self.pos
+                size = section['size']
+
+                if self.header_only:
+                    self.reached_data = True
+                    break
+
+                is_binary = self.file_info.get('is_binary',BINARY_DEFAULT)
+                if is_binary:
+                    data_end = self.pos + size
+                else:
+                    data_end = find_ascii_section_end( self.buf, self.pos )
+                    section['size'] = data_end - self.pos
+                encoded_buf = self.view[self.pos:data_end]
+                self.pos = data_end
+
+                if self.lazy:
+                    arr = LazyArray( self.filename, section, is_binary,
+                                     use_mmap=self.use_mmap, order=self.order,
+                                     native=self.native )
+                elif self.executor is not None:
+                    arr = self.executor.submit( decode_section, encoded_buf, section,
+                                                is_binary, order=self.order,
+                                                native=self.native )
+                else:
+                    arr = decode_section( encoded_buf, section, is_binary,
+                                          order=self.order, native=self.native )
+
+                yield Token( TOKEN_BYTEDATA, {'data':arr}, token.start, token.end )
+            if self.reached_data:
+                break
+        yield Token( TOKEN_ENDMARKER, '', self.pos, self.pos )
+
+# a line with only whitespace, which ends an ASCII data section
+re_blank_line = re.compile(br'\n[ \t\r]*(\n|$)')
+
+def find_ascii_section_end( buf, pos ):
+    """return the position just past the blank line ending the ASCII data at pos"""
+    # pos is at the start of a line, so search from the preceding newline
+    matchobj = re_blank_line.search( buf, max(pos-1,0) )
+    if matchobj is None:
+        return len(buf)
+    return matchobj.end()
+
+def parse_ascii_section( buf, section ):
+    """parse all numbers of an ASCII data section in a single pass
+
+    The numbers are parsed straight into the declared element type, with
+    the declared number of components as a trailing dimension. The
+    array has the shape of the data as stored, x fastest.
+    """
+    dtype = np.dtype(section['dtype'])
+    with warnings.catch_warnings():
+        # unparseable text ends the array early, which is caught below
+        warnings.simplefilter('ignore', DeprecationWarning)
+        arr = np.fromstring( bytes(buf), dtype=dtype, sep=' ' )
+    if section['shape'] is None:
+        shape = (-1,)
+        if section['components'] > 1:
+            shape = (-1, section['components'])
+        n_expected = len(arr) - len(arr) % section['components']
+    else:
+        shape = section_shape(section, order='zyx-C')
+        n_expected = int(np.prod(shape))
+    if len(arr) != n_expected:
+        raise ValueError('ASCII data section @%d has %d numbers, expected %d'%(
+            section['id'], len(arr), n_expected))
+    return arr.reshape(shape)
+
+def element_dtype( element_type, byte_order ):
+    """the numpy dtype of an element type ('byte', 'float', ...)"""
+    if element_type is None:
+        # no declaration, assume bytes
+        element_type = 'byte'
+    if element_type not in element_dtypes:
+        raise ValueError('unknown element type %r'%element_type)
+    return np.dtype( element_dtypes[element_type] ).newbyteorder( '>' if byte_order=='big' else '<' )
+
+# memory layouts of decoded data sections:
+#
+# None: a view indexed (x, y, z), without copying the stored data
+# 'xyz-F': indexed (x, y, z) and Fortran contiguous, x fastest
+# 'zyx-C': indexed (z, y, x) and C contiguous, as stored in the file
+#
+# Components of multi-component data are always the last axis.
+ORDERS = (None, 'xyz-F', 'zyx-C')
+
+def section_shape( section, order=None ):
+    """the shape of the decoded array, with components as a trailing dimension"""
+    shape = tuple(section['shape'])
+    if order=='zyx-C':
+        shape = tuple(reversed(shape))
+    if section['components'] > 1:
+        shape = shape + (section['components'],)
+    return shape
+
+def lattice_order( arr, ndim, order ):
+    """lay out arr, stored C contiguous with ndim lattice axes, as given by order"""
+    if order=='zyx-C':
+        return arr
+    # reverse the lattice axes to (x, y, z), keeping components last
+    axes = list(reversed(range(ndim))) + list(range(ndim, arr.ndim))
+    arr = arr.transpose(axes)
+    if order=='xyz-F':
+        # no copy for scalar data, which is then Fortran contiguous already
+        arr = np.asfortranarray(arr)
+    return arr
+
+# the phase of decoding each encoding of binary data sections
+DECODE_PHASES = {'raw':'raw', 'HxZip':'zlib', 'HxByteRLE':'rle'}
+
+def decode_section( buf, section, is_binary, order=None, out=None, native=False ):
+    """decode the encoded bytes buf of a data section into an array
+
+    Binary data keeps the byte order of the file, given by the dtype,
+    unless native is True (see to_native()). The memory layout is given
+    by order, see ORDERS.
+
+    If out is given, it must be a C contiguous array with the shape of
+    the data as stored (that is, section_shape(section, 'zyx-C')), and
+    the data is decoded into it rather than into a new array. Its dtype
+    is that of the section, possibly in native byte order.
+    """
+    if not is_binary:
+        phase = 'ascii'
+    else:
+        phase = DECODE_PHASES.get( section['encoding'] )
+        if phase is None:
+            raise ValueError('unknown encoding %r'%section['encoding'])
+    if observers:
+        notify_start( phase, section['id'] )
+
+    if not is_binary:
+        arr = parse_ascii_section(buf, section)
+        if out is not None:
+            out[...] = arr
+            arr = out
+    else:
+        dtype = np.dtype(section['dtype'])
+        # the file stores x fastest, so in C order the lattice is (z, y, x)
+        stored_shape = section_shape( section, order='zyx-C' )
+        if out is not None:
+            # decode the bytes as stored, whatever the byte order of out
+            out = out.view( dtype )
+        if phase=='raw':
+            # a view into the file buffer (or the memory mapped file
+            # itself), no copy
+            arr = np.frombuffer( buf, dtype=dtype )
+            if out is not None:
+                np.copyto( out.reshape(-1), arr )
+                arr = out
+        elif phase=='zlib':
+            arr = np.empty( stored_shape, dtype=dtype ) if out is None else out
+            zlib_decompress_into( buf, arr )
+        else:
+            arr = np.empty( stored_shape, dtype=dtype ) if out is None else out
+            rle_decompress_into( buf, arr )
+        arr.shape = stored_shape
+
+    if observers:
+        notify_end( phase, section['id'], len(buf), arr.nbytes )
+        notify_start( 'layout', section['id'] )
+    if native:
+        arr = to_native( arr )
+    if section['shape'] is not None:
+        arr = lattice_order( arr, len(section['shape']), order )
+    if observers:
+        notify_end( 'layout', section['id'], arr.nbytes, arr.nbytes )
+    return arr
+
+class LazyArray:
+    """a data section which is read and decoded only when it is used
+
+    The shape, dtype and nbytes are known without reading the data. The
+    data is read from the file and decoded on the first call to
+    np.asarray() or on indexing, and then kept.
+
+    If cache is an ArrayCache, the decoded array is looked up there
+    under cache_key first, and put there otherwise.
+    """
+    def __init__( self, filename, section, is_binary, use_mmap=False, order=None, native=False,
+                  cache=None, cache_key=None ):
+        # absolute, so the file is still found after os.chdir()
+        self.filename = os.path.abspath( os.fsdecode(filename) )
+        self.section = section
+        self.is_binary = is_binary
+        self.use_mmap = use_mmap
+        self.order = order
+        self.native = native
+        self.cache = cache
+        self.cache_key = cache_key
+        self._array = None
+
+    @property
+    def offset(self):
+        return self.section['offset']
+
+    @property
+    def encoding(self):
+        return self.section['encoding']
+
+    @property
+    def shape(self):
+        if self.section['shape'] is None:
+            # only known once parsed
+            return self.load().shape
+        return section_shape(self.section, order=self.order)
+
+    @property
+    def dtype(self):
+        dtype = np.dtype(self.section['dtype'])
+        if self.native:
+            dtype = dtype.newbyteorder('=')
+        return dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        n = self.dtype.itemsize
+        for dim in self.shape:
+            n *= dim
+        return n
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return '<LazyArray section @%d of %r, shape %r, dtype %s>'%(
+            self.section['id'], self.filename, self.shape, self.dtype)
+
+    def read_encoded(self):
+        """read the encoded bytes of the data section"""
+        offset, size = self.section['offset'], self.section['size']
+        with open(self.filename,mode='rb') as fileobj:
+            if self.use_mmap:
+                return memoryview(map_buffer(fileobj))[offset:offset+size]
+            fileobj.seek(offset)
+            return read_buffer(fileobj, max_bytes=size)
+
+    def load(self):
+        """read and decode the data, returning the array"""
+        if self._array is None and self.cache is not None:
+            self._array = self.cache.get( self.cache_key )
+        if self._array is None:
+            self._array = decode_section( self.read_encoded(), self.section,
+                                          self.is_binary, order=self.order,
+                                          native=self.native )
+            if self.cache is not None:
+                self._array = self.cache.put( self.cache_key, self._array )
+        return self._array
+
+    def readinto(self, out):
+        """read and decode the data into out, without keeping it
+
+        out is a C contiguous array with the shape of the data as stored,
+        see decode_section().
+        """
+        return decode_section( self.read_encoded(), self.section,
+                               self.is_binary, order=self.order, out=out,
+                               native=self.native )
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self.load()
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+def parse_ascii_data(buf,dtype):
+    """parse lines of 3 numbers into an (n, 3) array of dtype in one pass"""
+    with warnings.catch_warnings():
+        # unparseable text ends the array early, which is caught below
+        warnings.simplefilter('ignore', DeprecationWarning)
+        result = np.fromstring(bytes(buf), dtype=dtype, sep=' ')
+    if len(result) % 3 != 0:
+        raise ValueError('cannot parse %r as rows of 3 numbers'%lim_repr(bytes(buf)))
+    result.shape = (len(result)//3, 3)
     return result
 
+def parse_binary_data(buf,dtype,byte_order='big'):
+    """view binary rows of 3 numbers as an (n, 3) array, without a copy
+
+    The array has the byte order of the file, e.g. '>f4' for big endian
+    float data, see to_native().
+    """
+    dtype = np.dtype(dtype).newbyteorder( '>' if byte_order=='big' else '<' )
+    result = np.frombuffer(buf, dtype=dtype)
+    result.shape = (len(result)//3, 3)
+    return result
+
+def to_native( arr ):
+    """return arr in the native byte order of this machine
+
+    Arrays already in native order are returned as they are. Writable
+    arrays are byte swapped in place and returned as a view with the
+    native dtype, read-only arrays (such as views of a memory mapped
+    file) are copied.
+    """
+    if arr.dtype.isnative:
+        return arr
+    native_dtype = arr.dtype.newbyteorder('=')
+    if arr.flags.writeable:
+        arr.byteswap( inplace=True )
+        return arr.view( native_dtype )
+    return arr.astype( native_dtype )
+
 def is_debug():
     return bool(int(os.environ.get('DEBUG_AMIRA','0')))
 
@@ -337,96 +1091,88 @@ def dbgprn( *args, **kwargs ):
     if is_debug():
         print( *args, **kwargs )
 
-def atom( src, token, tokenizer, level=0, block_descent=False ):
-    space = '  '*level
-    dbgprn('%sATOM LEVEL %d, token[0]=%r'%(space, level, token[0]))
-    end_block = None
-    if token[0]==TOKEN_NAME:
-        name = token[1]
-        dbgprn('%sATOM LEVEL %d name: %r'%(space, level, name))
+# the phases of reading a file, as passed to observers
+#
+# 'read': reading (or memory mapping) the file into a buffer
+# 'tokenize': splitting a stretch of the header into tokens
+# 'atoms': parsing the tokens, which contains all other phases but 'read'
+# 'raw', 'zlib', 'rle', 'ascii': decoding a data section
+# 'layout': laying out a decoded data section as requested
+# 'vertices': parsing the Vertices or Triangles of a HyperSurface
+PHASES = ('read', 'tokenize', 'atoms', 'raw', 'zlib', 'rle', 'ascii', 'layout', 'vertices')
 
-        if block_descent:
-            result = name
-        else:
-            next_token = next(src)
+observers = []
 
-            if next_token[0] == TOKEN_OP and next_token[1]=='{':
-                # this name begins a '{' block
-                value, ended_with = atom( src, next_token, tokenizer, level=level+1 ) # create {}
-                result = {name: value}
+class Observer:
+    """base class of the observers of reading files, see add_observer()
 
-            elif name in ARRAY_FIELDS: # if name in ['Vertices', 'Triangles']:
-                # this name begins an array
-                assert next_token[0]==TOKEN_NUMBER
-                n_vectors = int(next_token[1])
-                next_token = next(src)
-                assert next_token[0]==TOKEN_NEWLINE
-                next_token = next(src)
-                assert next_token[0]==TOKEN_Vec3Array
-                value = next_token[1]
-                assert len(value)==n_vectors
-                result = {name: value}
+    start() is called when a phase (see PHASES) starts and end() when
+    it ends. Phases can contain others, 'atoms' contains the decoding of
+    data sections, for example. section is the id N of the ``@N`` data
+    section the phase works on, if any. bytes_in and bytes_out are the
+    numbers of bytes consumed and produced, if known.
 
-            else:
-                # continue until newline
-                elements = []
-                ended_with = None
-                force_colon = False
-                while not (next_token[0] == TOKEN_NEWLINE):
-
-                    if next_token[0] == TOKEN_COLON:
-                        force_colon = True
-                        next_token = next(src)
-
-                    value, ended_with = atom( src, next_token, tokenizer, level=level+1, block_descent=force_colon ) # fill element of []
-                    elements.append( value )
-                    dbgprn('%sATOM LEVEL %d appended element %r'%(space, level, elements[-1]))
-                    if ended_with is not None:
-                        break
-                    next_token = next(src)
+    With threads, the phases of different sections are reported from
+    different threads at the same time. If reading fails, the phases
+    under way do not end.
+    """
+    def start( self, phase, section=None ):
+        pass
 
-                if ended_with is not None:
-                    end_block = ended_with
-                else:
-                    # loop ended because we hit a newline
-                    end_block = 'newline'
+    def end( self, phase, section=None, bytes_in=None, bytes_out=None ):
+        pass
 
-                dbgprn('%sATOM LEVEL %d elements 1: %r'%(space, level, elements))
-                elements = [e for e in elements if e is not None]
-                dbgprn('%sATOM LEVEL %d elements 2: %r'%(space, level, elements))
-                if len(elements)==0:
-                    result = name
-                elif len(elements)==1:
-                    result = {name: elements[0]}
-                else:
-                    result = {name: elements}
-    elif token[0] in [TOKEN_COMMENT, TOKEN_COMMA]:
-        result = None
-    elif token[0] == TOKEN_OP and token[1]=='}':
-        result = None
-        end_block = 'block'
-    elif token[0] == TOKEN_NEWLINE:
-        result = None
-        end_block = 'newline'
-    elif token[0] == TOKEN_OP and token[1]=='{':
-        if block_descent:
-            raise RuntimeError('descent blocked but encountered block')
-
-        elements = []
-
-        # parse to end of block
-        next_token = next(src)
-        while not (next_token[0] == TOKEN_OP and next_token[1] == '}'):
-            value, ended_with = atom( src, next_token, tokenizer, level=level+1 ) # fill element of {}
-            elements.append( value )
-            if ended_with=='block':
-                break
-            next_token = next(src)
+def add_observer( observer ):
+    """report the phases of reading files to observer, an Observer
+
+    Without observers, nothing is timed or reported.
+    """
+    observers.append( observer )
+
+def remove_observer( observer ):
+    observers.remove( observer )
+
+def notify_start( phase, section=None ):
+    for observer in observers:
+        observer.start( phase, section )
+
+def notify_end( phase, section=None, bytes_in=None, bytes_out=None ):
+    for observer in observers:
+        observer.end( phase, section, bytes_in, bytes_out )
+
+class NameFrame:
+    """a name whose values are being parsed, up to the end of the line"""
+    __slots__ = ('name', 'elements', 'force_colon')
+
+    def __init__( self, name ):
+        self.name = name
+        self.elements = []
+        self.force_colon = False
+
+    def result( self ):
+        elements = [e for e in self.elements if e is not None]
+        if len(elements)==0:
+            return self.name
+        elif len(elements)==1:
+            return {self.name: elements[0]}
+        return {self.name: elements}
+
+class BlockFrame:
+    """a '{' block whose elements are being parsed, up to the '}'
 
-        elements = [e for e in elements if e is not None]
-        dbgprn('%sATOM LEVEL %d: done, elements %r'%(space, level, elements))
+    name is the name before the '{', if any.
+    """
+    __slots__ = ('name', 'elements')
+
+    def __init__( self, name=None ):
+        self.name = name
+        self.elements = []
+
+    def result( self ):
         result = collections.OrderedDict()
-        for element in elements:
+        for element in self.elements:
+            if element is None:
+                continue
             if isinstance(element,dict):
                 for key in element:
                     assert key not in result
@@ -435,71 +1181,1073 @@ def atom( src, token, tokenizer, level=0, block_descent=False ):
                 assert isinstance(element,type(u'unicode string'))
                 assert element not in result
                 result[element] = None
-    elif token[0]==TOKEN_NUMBER:
-        try:
-            value = int(token[1])
-        except ValueError:
-            value = float(token[1])
-        result = value
-    elif token[0]==TOKEN_STRING:
-        value = token[1]
-        result = value
-    elif token[0]==TOKEN_BYTEDATA_INFO:
-        result = None
-    elif token[0]==TOKEN_BYTEDATA:
-        result = token[1]
-    elif token[0]==TOKEN_EQUALS:
-        result = None
-    else:
-        raise ValueError('unexpected token type: %r'%(token[0],))
+        if self.name is not None:
+            return {self.name: result}
+        return result
 
-    dbgprn('%sATOM LEVEL %d: done, returning %r (end_block: %s)'%(space, level, lim_repr(result), end_block))
+def atom( src, token, tokenizer, block_descent=False ):
+    """parse the atom starting with token, reading more tokens from src
+
+    Returns the atom and what ended it: 'newline', 'block' (a '}'), or
+    None. A name followed by values to the end of the line becomes a
+    dict {name: value} (or {name: [values]}), a '{' block an OrderedDict
+    of its elements. Nested blocks and names are kept on an explicit
+    stack, so there is no limit on the depth of nesting.
+    """
+    debug = tokenizer.debug
+    stack = []
+    while True:
+        # parse token into a result, unless it starts a name or block
+        # which is then put on the stack
+        result = None
+        end_block = None
+        kind = token.kind
+        if debug:
+            dbgprn('%sATOM LEVEL %d, token %r'%('  '*len(stack), len(stack), token))
+        if kind==TOKEN_NAME:
+            name = token.value
+            if block_descent:
+                result = name
+            else:
+                next_token = next(src)
+                if next_token.kind == TOKEN_OP and next_token.value=='{':
+                    # this name begins a '{' block
+                    stack.append( BlockFrame(name) )
+                    token = next(src)
+                    if not (token.kind == TOKEN_OP and token.value == '}'):
+                        continue
+                    result = stack.pop().result()
+                elif name in ARRAY_FIELDS: # if name in ['Vertices', 'Triangles']:
+                    # this name begins an array
+                    assert next_token.kind==TOKEN_NUMBER
+                    n_vectors = int(next_token.value)
+                    next_token = next(src)
+                    assert next_token.kind==TOKEN_NEWLINE
+                    next_token = next(src)
+                    assert next_token.kind==TOKEN_Vec3Array
+                    value = next_token.value
+                    # value is None when only the header is parsed
+                    assert value is None or len(value)==n_vectors
+                    result = {name: value}
+                elif next_token.kind == TOKEN_NEWLINE:
+                    result = name
+                    end_block = 'newline'
+                else:
+                    # continue until newline
+                    frame = NameFrame(name)
+                    stack.append( frame )
+                    token = next_token
+                    if token.kind == TOKEN_COLON:
+                        frame.force_colon = True
+                        token = next(src)
+                    block_descent = frame.force_colon
+                    continue
+        elif kind in (TOKEN_COMMENT, TOKEN_COMMA, TOKEN_BYTEDATA_INFO, TOKEN_EQUALS):
+            pass
+        elif kind == TOKEN_OP and token.value=='}':
+            end_block = 'block'
+        elif kind == TOKEN_NEWLINE:
+            end_block = 'newline'
+        elif kind == TOKEN_OP and token.value=='{':
+            if block_descent:
+                raise RuntimeError('descent blocked but encountered block')
+            stack.append( BlockFrame() )
+            token = next(src)
+            if not (token.kind == TOKEN_OP and token.value == '}'):
+                block_descent = False
+                continue
+            result = stack.pop().result()
+        elif kind==TOKEN_NUMBER:
+            try:
+                result = int(token.value)
+            except ValueError:
+                result = float(token.value)
+        elif kind==TOKEN_STRING:
+            result = token.value
+        elif kind==TOKEN_BYTEDATA:
+            result = token.value
+        else:
+            raise ValueError('unexpected token type: %r'%(kind,))
 
-    return result, end_block
+        # hand the result to the names and blocks it is part of, until
+        # one of them needs the next token
+        while True:
+            if debug:
+                dbgprn('%sATOM LEVEL %d: done, returning %s (end_block: %s)'%(
+                    '  '*len(stack), len(stack), lim_repr(result), end_block))
+            if not len(stack):
+                return result, end_block
+            frame = stack[-1]
+            frame.elements.append( result )
+            if isinstance(frame, NameFrame):
+                if end_block is None:
+                    token = next(src)
+                    if token.kind != TOKEN_NEWLINE:
+                        if token.kind == TOKEN_COLON:
+                            frame.force_colon = True
+                            token = next(src)
+                        block_descent = frame.force_colon
+                        break
+                    end_block = 'newline'
+                # the name ends with the line or block which ended its
+                # last value
+                stack.pop()
+                result = frame.result()
+            else:
+                if end_block != 'block':
+                    token = next(src)
+                    if not (token.kind == TOKEN_OP and token.value == '}'):
+                        block_descent = False
+                        break
+                stack.pop()
+                result = frame.result()
+                end_block = None
 
 def debugger( src ):
     for x in src:
         space = '  '*20
-        if x[0]==TOKEN_BYTEDATA:
-            print(space,'TOKEN','bytedata: %d'%(len(x[1]['data'])))
-        elif x[0]==TOKEN_Vec3Array:
-            print(space,'TOKEN','Vec3Array: shape: %s'%(x[1].shape,))
+        if x.kind==TOKEN_BYTEDATA:
+            print(space,'TOKEN','bytedata: %r'%(getattr(x.value['data'],'shape',x.value['data']),))
+        elif x.kind==TOKEN_Vec3Array:
+            print(space,'TOKEN','Vec3Array: shape: %s'%(getattr(x.value,'shape',None),))
         else:
             print(space,'TOKEN',x)
         yield x
 
-def read_amira( filename ):
+def read_amira( filename, mmap=False, lazy=False, order=None, threads=None, native=False,
+                cache_dir=None, array_cache=None ):
+    """load .surf or .am file
+
+    If mmap is True, the file is memory mapped instead of read. Raw
+    encoded data sections are then returned as read-only arrays backed
+    directly by the file, so no voxels are read until they are touched.
+
+    If lazy is True, each data section (``@N``) is returned as a
+    LazyArray which is only read and decoded when it is first used.
+
+    order sets the memory layout of the data sections. By default they
+    are views indexed (x, y, z). With 'xyz-F' they are indexed (x, y, z)
+    and Fortran contiguous, with 'zyx-C' they are indexed (z, y, x) and C
+    contiguous. Either way consumers needing contiguous memory can use
+    the array without a copy.
+
+    If threads is given, the data sections are decoded concurrently by
+    a pool of that many threads, each section as soon as its end in the
+    file is known. Decompression releases the GIL, so a file with many
+    data sections then loads in about the time of its largest one.
+
+    Binary data (data sections as well as HyperSurface Vertices and
+    Triangles) keeps the byte order of the file, given by 'byte_order'
+    in the 'info' of the result, and is not copied for that. If native
+    is True, it is converted to the native byte order of this machine,
+    in place where possible, see to_native().
+
+    If cache_dir is given, the parsed header and the table of data
+    sections are kept in a HeaderCache in that directory. Once cached,
+    the header of an AmiraMesh file is not parsed again (until the file
+    changes), its data sections are read straight from their offsets.
+
+    If array_cache is given, an ArrayCache, decoded data sections are
+    taken from it, or decoded and put there. They are read-only then.
+    """
+    if array_cache is not None:
+        return read_amira_array_cached( filename, array_cache, mmap=mmap, lazy=lazy,
+                                        order=order, threads=threads, native=native,
+                                        cache_dir=cache_dir )
+    if cache_dir is not None:
+        return read_amira_cached( filename, get_header_cache(cache_dir), mmap=mmap, lazy=lazy,
+                                  order=order, threads=threads, native=native )
     with open(filename,mode='rb') as fileobj:
-        result = read_amira_fileobj( fileobj )
+        result = read_amira_fileobj( fileobj, mmap=mmap, lazy=lazy, order=order,
+                                     threads=threads, native=native )
     return result
 
-def read_amira_fileobj( fileobj ):
+def read_amira_fileobj( fileobj, mmap=False, lazy=False, order=None, threads=None, native=False ):
     """load .surf or .am file"""
 
-    tokenizer = Tokenizer( fileobj )
+    if threads is None or lazy:
+        tokenizer = Tokenizer( fileobj, use_mmap=mmap, lazy=lazy, order=order, native=native )
+        result = parse_atoms( tokenizer )
+    else:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor( max_workers=threads ) as executor:
+            tokenizer = Tokenizer( fileobj, use_mmap=mmap, order=order, executor=executor,
+                                   native=native )
+            result = parse_atoms( tokenizer )
+            result = map_sections( result, lambda future: future.result(),
+                                   concurrent.futures.Future )
+
+    return {'info': tokenizer.file_info,
+            'data': result,
+            }
+
+def parse_atoms( tokenizer ):
+    """parse the tokens from tokenizer into a list of top-level atoms"""
     src = tokenizer.get_tokens()
 
-    if is_debug():
+    if tokenizer.debug:
         src = debugger(src)
 
+    if observers:
+        notify_start( 'atoms' )
     token = next(src)
 
     result = []
-    while token[0] != TOKEN_ENDMARKER:
+    while token.kind != TOKEN_ENDMARKER:
         this_atom, ended_with = atom(src, token, tokenizer) # get top-level atom
         if this_atom is not None:
             #assert isinstance( this_atom, dict )
             if isinstance( this_atom, dict ):
                 if 'define' in this_atom:
                     tokenizer.add_defines( this_atom['define'] )
+                for key in this_atom:
+                    matchobj = re_count_name.match( key )
+                    if matchobj is not None and isinstance(this_atom[key],int):
+                        tokenizer.add_defines( {matchobj.group(1): this_atom[key]} )
             result.append( this_atom )
         token = next(src)
 
+    if observers:
+        notify_end( 'atoms', bytes_in=tokenizer.pos )
+    return result
+
+HEADER_CHUNK_SIZE = 4096 # initial number of bytes read by read_amira_header
+
+def read_amira_header( filename, cache_dir=None ):
+    """parse the header of a .surf or .am file without reading its data
+
+    Only the first few KB of the file are read (more if the header is
+    longer). The result has the same 'info' and 'data' as read_amira()
+    up to the first data section, plus 'sections', a list with one dict
+    per data section giving its 'id', 'location', 'name', element
+    'type', 'components', numpy 'dtype', 'shape', 'encoding', byte
+    'offset' in the file and encoded 'size' in bytes. The offset and
+    size are None where they cannot be determined without reading the
+    data.
+
+    If cache_dir is given, the header is taken from the HeaderCache in
+    that directory, or parsed and put there. All offsets and sizes are
+    known then.
+    """
+    if cache_dir is not None:
+        index = get_header_cache(cache_dir).index( filename )
+        if index['sections'] is not None:
+            return {'info': index['info'],
+                    'data': index['header'],
+                    'sections': index['sections'],
+                    }
+    with open(filename,mode='rb') as fileobj:
+        file_size = os.fstat(fileobj.fileno()).st_size
+        max_bytes = HEADER_CHUNK_SIZE
+        while True:
+            fileobj.seek(0)
+            tokenizer = Tokenizer( fileobj, header_only=True, max_bytes=max_bytes )
+            try:
+                result = parse_atoms( tokenizer )
+            except (ValueError, StopIteration):
+                # the header was cut off, unless the whole file was read
+                if max_bytes >= file_size:
+                    raise
+                result = None
+            if result is not None and (tokenizer.reached_data or max_bytes >= file_size):
+                break
+            max_bytes *= 2
+        sections = tokenizer.get_sections()
+        locate_sections( fileobj, sections )
+
     return {'info': tokenizer.file_info,
             'data': result,
+            'sections': sections,
             }
 
+HEADER_CACHE_VERSION = 2 # of the format of the entries in a HeaderCache
+HEADER_CACHE_SUFFIX = '.amhdr'
+HEADER_CACHE_MAX_BYTES = 64*1024*1024 # default size limit of a HeaderCache
+
+def stat_key( st ):
+    """what identifies the version of a file, from its os.stat() result"""
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def index_amira( filename ):
+    """parse the header of a file and locate all its data sections
+
+    Returns a dict with the 'info' of the file, the 'header', that is
+    the top-level atoms before the first data section, and 'sections',
+    the table of all data sections as from read_amira_header() (with
+    every offset and size known). sections is None if the file is not
+    laid out as a header followed by its data sections, like a
+    HyperSurface file. 'stat' identifies the version of the file read.
+    """
+    with open(filename,mode='rb') as fileobj:
+        st = os.fstat( fileobj.fileno() )
+        # only the pages with the header and the section boundaries
+        # are read
+        tokenizer = Tokenizer( fileobj, lazy=True )
+        atoms = parse_atoms( tokenizer )
+
+    def is_section( value ):
+        return isinstance(value, dict) and isinstance(value.get('data'), LazyArray)
+    n_header = 0
+    while n_header < len(atoms) and not is_section(atoms[n_header]):
+        n_header += 1
+    header = atoms[:n_header]
+    sections = [value['data'].section for value in atoms[n_header:] if is_section(value)]
+    if len(sections) != len(atoms)-n_header or tokenizer.file_info.get('type')=='HyperSurface':
+        header, sections = None, None
+    return {'version': HEADER_CACHE_VERSION,
+            'filename': os.path.abspath(filename),
+            'stat': stat_key(st),
+            'info': tokenizer.file_info,
+            'header': header,
+            'sections': sections,
+            }
+
+def to_json( obj ):
+    """obj with plain dicts and tuples tagged, to be restored by from_json_pairs()
+
+    Parsed headers hold both OrderedDicts (blocks) and plain dicts, and
+    section shapes are tuples, which JSON alone does not tell apart.
+    """
+    if isinstance(obj, collections.OrderedDict):
+        return collections.OrderedDict( (key, to_json(value)) for key, value in obj.items() )
+    if isinstance(obj, dict):
+        return {'__dict__': [ [key, to_json(value)] for key, value in obj.items() ]}
+    if isinstance(obj, tuple):
+        return {'__tuple__': [ to_json(value) for value in obj ]}
+    if isinstance(obj, list):
+        return [ to_json(value) for value in obj ]
+    return obj
+
+def from_json_pairs( pairs ):
+    """the object_pairs_hook of json.load() undoing to_json()"""
+    if len(pairs)==1 and pairs[0][0]=='__dict__':
+        return dict( pairs[0][1] )
+    if len(pairs)==1 and pairs[0][0]=='__tuple__':
+        return tuple( pairs[0][1] )
+    return collections.OrderedDict( pairs )
+
+class HeaderCache:
+    """an on-disk cache of the headers and data section tables of files
+
+    Each file has one entry, the result of index_amira() as JSON, named
+    after the absolute path of the file. Entries are plain data, so
+    reading a shared cache runs no code from it. An entry is used only
+    as long as the size, modification time and inode of the file are
+    unchanged. Entries are written to a temporary file which is then
+    renamed, so processes can share the cache. When the entries add up
+    to more than max_bytes, the least recently used ones are deleted;
+    the total is tracked from the entries put, so the directory is
+    only listed when that goes over max_bytes. Use get_header_cache()
+    to share one instance per directory.
+    """
+    def __init__( self, directory, max_bytes=HEADER_CACHE_MAX_BYTES ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.nbytes = None # the total size of the entries, once listed
+        try:
+            os.makedirs( directory )
+        except OSError:
+            if not os.path.isdir( directory ):
+                raise
+
+    def entry_path( self, filename ):
+        name = hashlib.sha1( os.path.abspath(filename).encode('utf-8') ).hexdigest()
+        return os.path.join( self.directory, name + HEADER_CACHE_SUFFIX )
+
+    def get( self, filename ):
+        """the cached index of filename, or None if there is none or it is stale"""
+        path = self.entry_path( filename )
+        try:
+            with open(path,mode='r') as fd:
+                entry = json.load( fd, object_pairs_hook=from_json_pairs )
+        except Exception:
+            # missing, or unreadable (e.g. written by another version)
+            return None
+        if (not isinstance(entry, dict) or
+            entry.get('version') != HEADER_CACHE_VERSION or
+            entry.get('filename') != os.path.abspath(filename) or
+            entry.get('stat') != stat_key(os.stat(filename))):
+            return None
+        try:
+            # mark as recently used
+            os.utime( path, None )
+        except OSError:
+            pass
+        return entry
+
+    def put( self, filename, entry ):
+        """store the index of filename"""
+        try:
+            text = json.dumps( to_json(entry) )
+        except (TypeError, ValueError):
+            # not plain data, not cached
+            return
+        fd, tmp_path = tempfile.mkstemp( dir=self.directory, prefix='.tmp-' )
+        try:
+            with os.fdopen(fd,'w') as fileobj:
+                fileobj.write( text )
+            os.replace( tmp_path, self.entry_path(filename) )
+        except Exception:
+            os.remove( tmp_path )
+            raise
+        if self.nbytes is None or self.nbytes + len(text) > self.max_bytes:
+            self.evict()
+        else:
+            self.nbytes += len(text)
+
+    def index( self, filename ):
+        """the index of filename, from the cache or else made and cached"""
+        entry = self.get( filename )
+        if entry is None:
+            entry = index_amira( filename )
+            self.put( filename, entry )
+        return entry
+
+    def evict( self ):
+        """delete the least recently used entries while the total size is over max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir( self.directory ):
+            if not name.endswith( HEADER_CACHE_SUFFIX ):
+                continue
+            path = os.path.join( self.directory, name )
+            try:
+                st = os.stat( path )
+            except OSError:
+                # deleted by another process
+                continue
+            entries.append( (st.st_mtime, st.st_size, path) )
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove( path )
+            except OSError:
+                pass
+            total -= size
+        self.nbytes = total
+
+header_caches = {}
+header_caches_lock = threading.Lock()
+
+def get_header_cache( directory ):
+    """the HeaderCache of directory, made once per process"""
+    key = os.path.abspath( directory )
+    with header_caches_lock:
+        cache = header_caches.get( key )
+        if cache is None:
+            cache = header_caches[key] = HeaderCache( directory )
+        return cache
+
+def read_sections( fileobj, sections, is_binary, mmap=False, order=None, threads=None, native=False ):
+    """read and decode the data sections of fileobj at their known offsets
+
+    The arguments are as for read_amira().
+    """
+    if observers:
+        notify_start( 'read' )
+    if mmap:
+        view = memoryview( map_buffer(fileobj) )
+        bufs = [ view[s['offset']:s['offset']+s['size']] for s in sections ]
+    else:
+        bufs = []
+        for section in sections:
+            fileobj.seek( section['offset'] )
+            bufs.append( read_buffer(fileobj, max_bytes=section['size']) )
+    if observers:
+        notify_end( 'read', bytes_out=sum(len(buf) for buf in bufs) )
+
+    def decode( buf, section ):
+        return decode_section( buf, section, is_binary, order=order, native=native )
+    if threads is None or len(sections) < 2:
+        return [ decode(buf, section) for buf, section in zip(bufs, sections) ]
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor( max_workers=threads ) as executor:
+        return list( executor.map(decode, bufs, sections) )
+
+def read_amira_cached( filename, cache, mmap=False, lazy=False, order=None, threads=None, native=False ):
+    """load .surf or .am file as read_amira(), with the header from cache, a HeaderCache"""
+    index = cache.index( filename )
+    if index['sections'] is None:
+        # not a plain header followed by data
+        return read_amira( filename, mmap=mmap, lazy=lazy, order=order,
+                           threads=threads, native=native )
+
+    is_binary = index['info'].get('is_binary',BINARY_DEFAULT)
+    sections = index['sections']
+    if lazy:
+        arrays = [ LazyArray( filename, section, is_binary, use_mmap=mmap,
+                              order=order, native=native )
+                   for section in sections ]
+    else:
+        with open(filename,mode='rb') as fileobj:
+            arrays = read_sections( fileobj, sections, is_binary, mmap=mmap, order=order,
+                                    threads=threads, native=native )
+    return {'info': index['info'],
+            'data': index['header'] + [ {'data': arr} for arr in arrays ],
+            }
+
+ARRAY_CACHE_MAX_BYTES = 512*1024*1024 # default size limit of an ArrayCache
+
+class ArrayCache:
+    """a thread-safe in-memory cache of decoded data sections
+
+    Arrays are kept by key, see read_amira_array_cached(), and made
+    read-only, as they are shared by all callers getting them. When
+    their nbytes add up to more than max_bytes, the least recently used
+    ones are dropped. hits, misses and evictions count what happened
+    since the cache was made.
+    """
+    def __init__( self, max_bytes=ARRAY_CACHE_MAX_BYTES ):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._arrays = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__( self ):
+        return len(self._arrays)
+
+    def get( self, key ):
+        """the array for key, or None"""
+        with self._lock:
+            arr = self._arrays.get( key )
+            if arr is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._arrays.move_to_end( key )
+            return arr
+
+    def put( self, key, arr ):
+        """keep arr for key, returning it made read-only
+
+        An array larger than max_bytes is not kept. Threads which decode
+        the same data at once each put it, the last one is kept.
+        """
+        arr.flags.writeable = False
+        if arr.nbytes > self.max_bytes:
+            return arr
+        with self._lock:
+            old = self._arrays.pop( key, None )
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._arrays[key] = arr
+            self.nbytes += arr.nbytes
+            while self.nbytes > self.max_bytes:
+                dropped_key, dropped = self._arrays.popitem( last=False )
+                self.nbytes -= dropped.nbytes
+                self.evictions += 1
+        return arr
+
+    def clear( self ):
+        """drop all arrays"""
+        with self._lock:
+            self._arrays.clear()
+            self.nbytes = 0
+
+    def stats( self ):
+        """a dict of the counters and the current size"""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._arrays),
+                    'nbytes': self.nbytes,
+                    'max_bytes': self.max_bytes,
+                    }
+
+def read_amira_array_cached( filename, array_cache, mmap=False, lazy=False, order=None,
+                             threads=None, native=False, cache_dir=None ):
+    """load .surf or .am file as read_amira(), with data sections from array_cache
+
+    The arrays are kept under the absolute path, size, modification
+    time and inode of the file, the section id, order and native.
+    Sections which are not decoded (nothing with lazy, until used) are
+    not looked up, so reading a file for its metadata adds nothing.
+    """
+    identity = (os.path.abspath(filename),) + stat_key( os.stat(filename) )
+    result = read_amira( filename, mmap=mmap, lazy=True, order=order, native=native,
+                         cache_dir=cache_dir )
+
+    def use_cache( arr ):
+        arr.cache = array_cache
+        arr.cache_key = identity + (arr.section['id'], order, native)
+        return arr
+    result = map_sections( result, use_cache, LazyArray )
+    if lazy:
+        return result
+    if threads is None:
+        return map_sections( result, LazyArray.load, LazyArray )
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor( max_workers=threads ) as executor:
+        result = map_sections( result, lambda arr: executor.submit(arr.load), LazyArray )
+        return map_sections( result, lambda future: future.result(),
+                             concurrent.futures.Future )
+
+def locate_sections( fileobj, sections ):
+    """find the offsets of data sections by skipping over the previous ones
+
+    This is only possible where the encoded size of the previous section
+    is known.
+    """
+    for prev, section in zip(sections[:-1], sections[1:]):
+        if section['offset'] is not None:
+            continue
+        if prev['offset'] is None or prev['size'] is None:
+            break
+        end = prev['offset'] + prev['size']
+        fileobj.seek(end)
+        matchobj = re_section_start.match( fileobj.read(256) )
+        if matchobj is None or int(matchobj.group(1)) != section['id']:
+            break
+        section['offset'] = end + matchobj.end()
+
+def roi_indices( roi, n ):
+    """the indices selected by the slice roi along an axis of length n"""
+    if not isinstance(roi, slice):
+        raise TypeError('ROI must be given as slices, not %r'%(roi,))
+    return np.arange( *roi.indices(n) )
+
+def readinto_exact( fileobj, arr ):
+    """fill the C contiguous array arr from fileobj"""
+    view = memoryview( arr.reshape(-1).view(np.uint8) )
+    n_read = 0
+    while n_read < len(view):
+        n = fileobj.readinto( view[n_read:] )
+        if not n:
+            raise ValueError('unexpected end of file')
+        n_read += n
+
+def read_amira_roi( filename, section=1, x=slice(None), y=slice(None), z=slice(None) ):
+    """read a box out of a three dimensional data section of a binary .am file
+
+    section is the id N of the ``@N`` data section, and x, y and z are
+    slices selecting the box. Only the parts of the file needed are read:
+
+    * raw data is read row by row (or slab by slab, if the box spans
+      whole rows) straight into the result,
+    * HxZip data is decompressed as a stream, keeping only the z slabs
+      which intersect the box and stopping after the last of them,
+    * HxByteRLE data is parsed a window at a time, expanding only the z
+      slabs which intersect the box and stopping after the last of them.
+
+    Slices with a step other than 1 are applied after reading the box
+    spanning them. The result is indexed (x, y, z), like read_amira().
+    """
+    header = read_amira_header( filename )
+    if not header['info'].get('is_binary',BINARY_DEFAULT):
+        raise ValueError('ROI reads need a binary file')
+    matches = [s for s in header['sections'] if s['id']==section]
+    if not len(matches):
+        raise ValueError('no data section @%d in %r'%(section,filename))
+    info = matches[0]
+    if info['shape'] is None or len(info['shape'])!=3:
+        raise ValueError('data section @%d is not a three dimensional lattice'%section)
+    if info['offset'] is None:
+        raise ValueError('cannot locate data section @%d in %r'%(section,filename))
+
+    dtype = np.dtype(info['dtype'])
+    components = info['components']
+    nx, ny, nz = info['shape']
+    indices = [ roi_indices(x,nx), roi_indices(y,ny), roi_indices(z,nz) ]
+    if min(len(idx) for idx in indices)==0:
+        return np.empty( tuple(len(idx) for idx in indices) + section_shape(info)[3:], dtype=dtype )
+    (x0,x1), (y0,y1), (z0,z1) = [ (int(idx.min()), int(idx.max())+1) for idx in indices ]
+
+    element_size = dtype.itemsize*components
+    row_bytes = nx*element_size
+    slab_bytes = ny*row_bytes
+    component_shape = (components,) if components > 1 else ()
+
+    with open(filename,mode='rb') as fileobj:
+        if info['encoding']=='raw':
+            box = np.empty( (z1-z0, y1-y0, x1-x0) + component_shape, dtype=dtype )
+            for zi, zz in enumerate(range(z0,z1)):
+                if x0==0 and x1==nx:
+                    fileobj.seek( info['offset'] + zz*slab_bytes + y0*row_bytes )
+                    readinto_exact( fileobj, box[zi] )
+                else:
+                    for yi, yy in enumerate(range(y0,y1)):
+                        fileobj.seek( info['offset'] + zz*slab_bytes + yy*row_bytes + x0*element_size )
+                        readinto_exact( fileobj, box[zi,yi] )
+        else:
+            start, stop = z0*slab_bytes, z1*slab_bytes
+            fileobj.seek( info['offset'] )
+            if info['encoding']=='HxZip':
+                slabs = zlib_decompress_range( fileobj, info['size'], start, stop )
+            elif info['encoding']=='HxByteRLE':
+                slabs = np.empty( stop-start, dtype=np.uint8 )
+                pos = 0
+                for piece in iter_rle_decompress( iter_file_windows(fileobj, info['size']),
+                                                  start=start, stop=stop ):
+                    slabs[pos:pos+len(piece)] = piece
+                    pos += len(piece)
+            else:
+                raise ValueError('unknown encoding %r'%info['encoding'])
+            slabs = slabs.view(dtype).reshape( (z1-z0, ny, nx) + component_shape )
+            box = slabs[:, y0:y1, x0:x1].copy()
+
+    if any( len(idx) != hi-lo or (len(idx) > 1 and idx[1] < idx[0])
+            for idx, (lo,hi) in zip(indices, [(x0,x1),(y0,y1),(z0,z1)]) ):
+        # apply the steps of the slices
+        box = box[np.ix_( indices[2]-z0, indices[1]-y0, indices[0]-x0 )]
+    return box.transpose( (2,1,0) + tuple(range(3,box.ndim)) )
+
+STREAM_CHUNK_SIZE = 4*1024*1024 # bytes of decoded data yielded at a time
+
+def iter_section_data( fileobj, section, chunk_size=STREAM_CHUNK_SIZE ):
+    """yield the decoded bytes of a binary data section, a chunk at a time
+
+    section is as listed by read_amira_header(), with a known offset.
+    The data is in the order and byte order of the file, x fastest, as
+    uint8 arrays (or bytes) of about chunk_size bytes. Raw data is read
+    and HxZip and HxByteRLE data decoded as it is yielded, so only about
+    one chunk (and a window of encoded data) is held at a time. A ValueError is raised unless the data has the size given by
+    the section's shape and dtype.
+    """
+    if section['offset'] is None or section['shape'] is None:
+        raise ValueError('cannot locate data section @%d'%section['id'])
+    expected = np.dtype(section['dtype']).itemsize*section['components']
+    for dim in section['shape']:
+        expected *= dim
+    fileobj.seek( section['offset'] )
+    n_out = 0
+    encoding = section['encoding']
+    if encoding=='raw':
+        while n_out < expected:
+            chunk = fileobj.read( min(chunk_size, expected-n_out) )
+            if not len(chunk):
+                break
+            n_out += len(chunk)
+            yield chunk
+    elif encoding=='HxZip':
+        decompressor = zlib.decompressobj()
+        n_read = 0
+        tail = b''
+        while not decompressor.eof:
+            if len(tail):
+                chunk_in = tail
+            elif n_read < section['size']:
+                chunk_in = fileobj.read( min(chunk_size, section['size']-n_read) )
+                if not len(chunk_in):
+                    break
+                n_read += len(chunk_in)
+            else:
+                break
+            chunk = decompressor.decompress( chunk_in, chunk_size )
+            tail = decompressor.unconsumed_tail
+            n_out += len(chunk)
+            if n_out > expected:
+                raise ValueError('zlib data decompresses to more than the expected %d bytes'%expected)
+            if len(chunk):
+                yield chunk
+        chunk = decompressor.flush()
+        n_out += len(chunk)
+        if len(chunk) and n_out <= expected:
+            yield chunk
+    elif encoding=='HxByteRLE':
+        windows = iter_file_windows( fileobj, section['size'] )
+        for piece in iter_rle_decompress( windows, chunk_size=chunk_size ):
+            n_out += len(piece)
+            if n_out > expected:
+                raise ValueError('HxByteRLE data decodes to more than the expected %d bytes'%expected)
+            yield piece
+    else:
+        raise ValueError('unknown encoding %r'%encoding)
+    if n_out != expected:
+        raise ValueError('data section @%d decodes to %d bytes, expected %d'%(section['id'],n_out,expected))
+
+SHARED_ALIGNMENT = 64 # byte alignment of arrays in a shared memory block
+
+# a data section decoded into a shared memory block, as sent to the parent
+SharedSection = collections.namedtuple('SharedSection', ['offset', 'shape', 'dtype', 'ndim'])
+
+def map_sections( obj, func, types ):
+    """copy the parsed file obj, replacing each data section x of types with func(x)
+
+    Dicts keep their type, so OrderedDict blocks stay ordered.
+    """
+    if isinstance(obj, dict):
+        return type(obj)( (key, map_sections(value, func, types)) for key, value in obj.items() )
+    if isinstance(obj, list):
+        return [ map_sections(value, func, types) for value in obj ]
+    if isinstance(obj, types):
+        return func(obj)
+    return obj
+
+def read_amira_shared( filename, native=False ):
+    """load a file, decoding its data sections into one new shared memory block
+
+    Returns the name of the block (None if the file has no data
+    sections) and the result of read_amira() with each data section
+    replaced by a SharedSection locating it in the block. The block is
+    closed but not unlinked, this is up to the caller. native is as
+    for read_amira().
+    """
+    from multiprocessing import shared_memory
+
+    result = read_amira( filename, lazy=True, order='zyx-C', native=native )
+    sections = []
+    def locate( arr ):
+        if arr.section['shape'] is None:
+            arr.load() # ASCII data of unknown length
+            ndim = None
+        else:
+            ndim = len(arr.section['shape'])
+        offset = 0
+        if len(sections):
+            prev_arr, prev = sections[-1]
+            offset = prev.offset + -(-prev_arr.nbytes//SHARED_ALIGNMENT)*SHARED_ALIGNMENT
+        sections.append( (arr, SharedSection(offset, arr.shape, arr.dtype.str, ndim)) )
+        return sections[-1][1]
+    result = map_sections( result, locate, LazyArray )
+    if not len(sections):
+        return None, result
+
+    last = sections[-1][1]
+    shm = shared_memory.SharedMemory( create=True, size=max(last.offset + sections[-1][0].nbytes, 1) )
+    try:
+        for arr, spec in sections:
+            out = np.ndarray( spec.shape, dtype=spec.dtype, buffer=shm.buf, offset=spec.offset )
+            if arr.section['shape'] is None:
+                out[...] = arr.load()
+            else:
+                arr.readinto( out )
+            del out
+        shm.close()
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+    return shm.name, result
+
+class SharedBlock:
+    """a shared memory block, closed once no array uses it any more"""
+    def __init__( self, shm ):
+        self.shm = shm
+        self.bytes = np.frombuffer( shm.buf, dtype=np.uint8 )
+
+    def __del__( self ):
+        # the export of shm.buf must be released before closing
+        self.bytes = None
+        self.shm.close()
+
+class SharedView:
+    """an array in a SharedBlock, which keeps the block alive
+
+    np.asarray() of this gives the array, with this as its base.
+    """
+    def __init__( self, block, section ):
+        self.block = block
+        self.__array_interface__ = {
+            'version': 3,
+            'shape': tuple(section.shape),
+            'typestr': section.dtype,
+            'data': (block.bytes.ctypes.data + section.offset, False),
+            }
+
+def attach_shared( name, result, order=None ):
+    """turn the result of read_amira_shared() into arrays in the block name
+
+    The block is unlinked right away, and its memory freed once the
+    arrays are no longer used.
+    """
+    if name is None:
+        return result
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory( name=name )
+    shm.unlink()
+    block = SharedBlock( shm )
+    def attach( section ):
+        arr = np.asarray( SharedView(block, section) )
+        if section.ndim is None:
+            return arr
+        return lattice_order( arr, section.ndim, order )
+    return map_sections( result, attach, SharedSection )
+
+def discard_shared( future ):
+    """unlink the shared memory block of a finished read_amira_shared() call"""
+    from multiprocessing import shared_memory
+    if future.cancelled() or future.exception() is not None:
+        return
+    name = future.result()[0]
+    if name is not None:
+        shared_memory.SharedMemory( name=name ).unlink()
+
+def read_amira_many( filenames, workers=None, ordered=True, max_in_flight=None, order=None, native=False ):
+    """load many files in parallel worker processes
+
+    Yields (filename, result, error) for each file, where result is as
+    from read_amira() and error is None, or result is None and error is
+    the exception raised loading the file. Results are yielded in the
+    order of filenames, or as they are completed if ordered is False.
+
+    The workers decode the data sections straight into shared memory,
+    so the arrays are not pickled. workers is the number of processes
+    (by default the number of CPUs). At most max_in_flight files
+    (by default twice the number of workers) are loaded or waiting to
+    be yielded at a time, which bounds the memory used. order and native
+    are as for read_amira().
+
+    Requires Python 3.8 or later.
+    """
+    import concurrent.futures
+    from multiprocessing import resource_tracker
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2*workers
+    if max_in_flight < 1:
+        raise ValueError('max_in_flight must be at least 1')
+    # share one tracker with the workers, so blocks created by a worker
+    # and unlinked here are accounted for
+    resource_tracker.ensure_running()
+
+    filenames = iter(filenames)
+    pending = collections.OrderedDict() # future: filename, in submission order
+    executor = concurrent.futures.ProcessPoolExecutor( max_workers=workers )
+    try:
+        while True:
+            while len(pending) < max_in_flight:
+                filename = next(filenames, None)
+                if filename is None:
+                    break
+                pending[executor.submit( read_amira_shared, filename, native )] = filename
+            if not len(pending):
+                break
+            if ordered:
+                future = next(iter(pending))
+            else:
+                future = next(concurrent.futures.as_completed(pending))
+            filename = pending.pop(future)
+            try:
+                name, result = future.result()
+            except Exception as err:
+                yield filename, None, err
+            else:
+                yield filename, attach_shared( name, result, order=order ), None
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown( wait=True )
+        for future in pending:
+            discard_shared( future )
+
 def read_surf( fileobj ):
     results = read_amira(fileobj)
     assert results['info']['type']=='HyperSurface'
     return results['data']
+
+def surf_field_value( parts ):
+    """the value of a "Name value..." line of a HyperSurface, as parsed by atom()"""
+    values = []
+    for part in parts:
+        if is_number(part):
+            try:
+                values.append( int(part) )
+            except ValueError:
+                values.append( float(part) )
+        else:
+            values.append( part.decode('utf-8') )
+    if len(values)==1:
+        return values[0]
+    return values
+
+def read_surf_patches( filename, mmap=False, native=False ):
+    """load a binary .surf file with all patches' triangles in one array
+
+    The header is parsed as by read_amira(), then the rest of the file is
+    scanned line by line, recording where each patch's Triangles block
+    is instead of tokenizing it. Returns a dict with
+
+    * 'info' and 'data' as from read_amira(), up to the Vertices, plus
+      the fields (such as 'NBranchingPoints') after them,
+    * 'vertices', an (n, 3) float array viewing the file buffer,
+    * 'patches', a list with a dict of the fields of each patch
+      (such as 'InnerRegion'), including its number of 'Triangles',
+    * 'triangles', an (m, 3) int32 array of the triangles of all
+      patches, in native byte order,
+    * 'patch_offsets', where patch i has the triangles
+      triangles[patch_offsets[i]:patch_offsets[i+1]].
+
+    mmap and native are as for read_amira(), native applying to the
+    vertices.
+    """
+    with open(filename,mode='rb') as fileobj:
+        tokenizer = Tokenizer( fileobj, use_mmap=mmap, header_only=True )
+        data = parse_atoms( tokenizer )
+    info = tokenizer.file_info
+    if info.get('type')!='HyperSurface' or not info.get('is_binary',BINARY_DEFAULT):
+        raise ValueError('%r is not a binary HyperSurface file'%filename)
+    if not len(data) or 'Vertices' not in data[-1]:
+        raise ValueError('no Vertices in %r'%filename)
+    byte_order = info.get('byte_order','big')
+    data = data[:-1]
+    buf, view, pos = tokenizer.buf, tokenizer.view, tokenizer.pos
+
+    # the tokenizer stopped just after the "Vertices N" line
+    n_vertices = int( bytes(view[buf.rfind(b'\n', 0, pos-1)+1:pos]).split()[1] )
+    vertices = parse_binary_data( view[pos:pos+12*n_vertices], dtypes['Vertices'], byte_order )
+    if native:
+        vertices = to_native( vertices )
+    pos += vertices.nbytes
+    if len(vertices) != n_vertices:
+        raise ValueError('unexpected end of file in Vertices')
+
+    patches = []
+    blocks = [] # (offset, count) of each Triangles block
+    patch = None
+    buflen = len(buf)
+    while pos < buflen:
+        idx = buf.find( b'\n', pos )
+        if idx==-1:
+            idx = buflen
+        parts = bytes(view[pos:idx]).split()
+        pos = idx + 1
+        if not len(parts):
+            continue
+        if parts[0]==b'{':
+            patch = collections.OrderedDict()
+        elif parts[0]==b'}':
+            if patch is None:
+                raise ValueError('unmatched "}" in %r'%filename)
+            patches.append( patch )
+            patch = None
+        elif patch is None:
+            data.append( {parts[0].decode('utf-8'): surf_field_value(parts[1:])} )
+        elif parts[0]==b'Triangles':
+            count = int(parts[1])
+            patch['Triangles'] = count
+            blocks.append( (pos, count) )
+            pos += 12*count
+            if pos > buflen:
+                raise ValueError('unexpected end of file in Triangles')
+        else:
+            patch[parts[0].decode('utf-8')] = surf_field_value(parts[1:])
+    if patch is not None:
+        raise ValueError('unexpected end of file in patch')
+    if len(blocks) != len(patches):
+        raise ValueError('a patch without Triangles in %r'%filename)
+
+    counts = [count for _, count in blocks]
+    patch_offsets = np.zeros( len(counts)+1, dtype=np.int64 )
+    np.cumsum( counts, out=patch_offsets[1:] )
+    triangles = np.empty( (int(patch_offsets[-1]), 3), dtype=np.int32 )
+    for (offset, count), start in zip(blocks, patch_offsets):
+        # a single copy, swapping bytes as needed on the way
+        block = parse_binary_data( view[offset:offset+12*count], dtypes['Triangles'], byte_order )
+        triangles[start:start+count] = block
+
+    return {'info': info,
+            'data': data,
+            'vertices': vertices,
+            'patches': patches,
+            'triangles': triangles,
+            'patch_offsets': patch_offsets,
+            }
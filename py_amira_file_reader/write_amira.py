@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""write arrays as AmiraMesh lattice (.am) and HyperSurface (.surf) files"""
+from __future__ import print_function
+import zlib
+import struct
+import collections
+import numpy as np
+
+import py_amira_file_reader.read_amira as read_amira
+
+ENCODINGS = ('raw', 'HxZip', 'HxByteRLE')
+
+WRITE_CHUNK_BYTES = 4*1024*1024 # about this much data is encoded at a time
+FORMAT_CHUNK_ROWS = 65536 # rows of an ASCII array formatted at a time
+
+# room left in the header for the size of encoded data, which is only
+# known once written
+SIZE_FIELD_WIDTH = 20
+
+# the element type of each dtype
+element_types = dict( (np.dtype(dtype).name, name)
+                      for name, dtype in read_amira.element_dtypes.items() )
+
+def format_value( value ):
+    """the header text of a parameter value
+
+    Strings are written as they are, so quoted strings include their
+    quotes, as read_amira() returns them.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return ' '.join( format_value(v) for v in value )
+    if isinstance(value, (bool, np.bool_)):
+        return '%d'%value
+    if isinstance(value, (int, np.integer)):
+        return '%d'%value
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    raise ValueError('cannot write parameter value %r'%(value,))
+
+def format_parameters( parameters, indent='    ' ):
+    """the lines of the body of a Parameters block from a dict
+
+    Nested dicts become nested blocks. As in files written by Amira,
+    the other entries of a block are separated by commas.
+    """
+    lines = []
+    names = list(parameters.keys())
+    for i, name in enumerate(names):
+        value = parameters[name]
+        if isinstance(value, dict):
+            lines.append( '%s%s {'%(indent, name) )
+            lines.extend( format_parameters(value, indent+'    ') )
+            lines.append( '%s}'%indent )
+            continue
+        line = '%s%s %s'%(indent, name, format_value(value))
+        if i < len(names)-1 and not isinstance(parameters[names[i+1]], dict):
+            line += ','
+        lines.append( line )
+    return lines
+
+def rle_compress( buf ):
+    """HxByteRLE encode the bytes of a uint8 array
+
+    Runs of two or more equal bytes become repeat blocks, everything
+    else literal blocks, each at most 127 bytes long.
+    """
+    data = np.ascontiguousarray(buf).reshape(-1).view(np.uint8)
+    if not len(data):
+        return b''
+    starts = np.concatenate( ([0], np.flatnonzero(data[1:] != data[:-1]) + 1) )
+    lengths = np.diff( np.concatenate((starts, [len(data)])) )
+
+    # segments are repeated runs or maximal groups of single bytes
+    single = lengths==1
+    begins = np.ones(len(starts), dtype=bool)
+    begins[1:] = ~single[1:] | ~single[:-1]
+    begin_idx = np.flatnonzero(begins)
+    seg_start = starts[begin_idx]
+    seg_len = np.add.reduceat( lengths, begin_idx )
+    seg_repeat = ~single[begin_idx]
+
+    # split segments into blocks of up to 127 bytes
+    n_blocks = (seg_len + 126)//127
+    block_seg = np.repeat( np.arange(len(seg_len)), n_blocks )
+    first_block = np.cumsum(n_blocks) - n_blocks
+    piece = np.arange(len(block_seg)) - np.repeat(first_block, n_blocks)
+    block_start = seg_start[block_seg] + 127*piece
+    block_len = np.minimum( 127, seg_len[block_seg] - 127*piece )
+    block_repeat = seg_repeat[block_seg]
+
+    out_len = 1 + np.where(block_repeat, 1, block_len)
+    out_start = np.cumsum(out_len) - out_len
+    out = np.empty( int(out_len.sum()), dtype=np.uint8 )
+    out[out_start] = np.where(block_repeat, block_len, 128 + block_len)
+    out[out_start[block_repeat]+1] = data[block_start[block_repeat]]
+    # literal bytes keep their order, shifted by their block
+    literal = ~block_repeat
+    src = np.flatnonzero( np.repeat(single, lengths) )
+    shift = np.repeat( out_start[literal] + 1 - block_start[literal], block_len[literal] )
+    out[src + shift] = data[src]
+    return out.tobytes()
+
+ADLER_BASE = 65521 # the modulus of Adler-32
+
+def adler32_combine( adler1, adler2, len2 ):
+    """the Adler-32 of two buffers joined, from the Adler-32 of each and the length of the second
+
+    As adler32_combine() of zlib, which Python does not expose.
+    """
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem*sum1) % ADLER_BASE
+    sum1 = (sum1 + (adler2 & 0xffff) + ADLER_BASE - 1) % ADLER_BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - rem) % ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+def deflate_block( data, level ):
+    """raw deflate data as a block ending on a byte boundary, with no references to earlier data"""
+    compressor = zlib.compressobj( level, zlib.DEFLATED, -zlib.MAX_WBITS )
+    encoded = compressor.compress( data ) + compressor.flush( zlib.Z_FULL_FLUSH )
+    return encoded, zlib.adler32( data ), memoryview(data).nbytes
+
+class BlockCompressor:
+    """compress into one zlib stream, deflating blocks concurrently
+
+    Like zlib.compressobj(), but the data of each call to compress() is
+    deflated on its own in executor (zlib releases the GIL), as pigz
+    does. Each block ends with a full flush, so the blocks join into a
+    single valid zlib stream, whose Adler-32 is combined from those of
+    the blocks. After the flush, decompression can also start at any
+    block: boundaries lists the offset of each block in the data and in
+    the stream.
+
+    compress() returns the blocks done so far, in order; at most
+    max_pending blocks are kept waiting.
+    """
+    def __init__( self, executor, level=zlib.Z_DEFAULT_COMPRESSION, max_pending=4 ):
+        self.executor = executor
+        self.level = level
+        self.max_pending = max_pending
+        self.boundaries = []
+        self._pending = collections.deque()
+        self._adler = 1
+        self._raw_size = 0
+        # the zlib header, as written for this level
+        self._encoded_size = 2
+        self._header = zlib.compress( b'', level )[:2]
+
+    def _collect( self, wait ):
+        encoded = []
+        while len(self._pending) and (wait or self._pending[0].done() or
+                                      len(self._pending) > self.max_pending):
+            block, adler, raw_size = self._pending.popleft().result()
+            self.boundaries.append( (self._raw_size, self._encoded_size) )
+            self._adler = adler32_combine( self._adler, adler, raw_size )
+            self._raw_size += raw_size
+            self._encoded_size += len(block)
+            encoded.append( block )
+        return encoded
+
+    def compress( self, data ):
+        if memoryview(data).nbytes:
+            self._pending.append( self.executor.submit(deflate_block, data, self.level) )
+        encoded = self._collect( wait=False )
+        if self._header is not None:
+            encoded.insert( 0, self._header )
+            self._header = None
+        return b''.join( encoded )
+
+    def flush( self ):
+        encoded = self._collect( wait=True )
+        if self._header is not None:
+            encoded.insert( 0, self._header )
+            self._header = None
+        # an empty final block, then the checksum
+        finisher = zlib.compressobj( self.level, zlib.DEFLATED, -zlib.MAX_WBITS )
+        encoded.append( finisher.flush(zlib.Z_FINISH) )
+        encoded.append( struct.pack('>I', self._adler) )
+        return b''.join( encoded )
+
+def iter_chunks( arr, dtype, chunk_bytes=WRITE_CHUNK_BYTES ):
+    """the data of arr, indexed (x, y, z[, component]), in file order
+
+    Whole z planes are converted at a time, so only about chunk_bytes
+    of arr are copied at once.
+    """
+    plane_bytes = max( arr[:,:,0].size*dtype.itemsize, 1 )
+    n_planes = max( chunk_bytes//plane_bytes, 1 )
+    for z in range(0, arr.shape[2], n_planes):
+        chunk = arr[:,:,z:z+n_planes]
+        # x fastest, then y, then z, with components interleaved
+        chunk = chunk.transpose( [2,1,0] + list(range(3, arr.ndim)) )
+        yield np.ascontiguousarray( chunk, dtype=dtype )
+
+def write_amira( filename, arr, parameters=None, encoding='raw', name='Data',
+                 byte_order='little', chunk_bytes=WRITE_CHUNK_BYTES,
+                 level=zlib.Z_DEFAULT_COMPRESSION, threads=None ):
+    """write arr as the lattice of a binary AmiraMesh file
+
+    arr is indexed (x, y, z), as returned by read_amira(), with vector
+    components as a fourth dimension. Its dtype must be one of
+    read_amira.element_dtypes. parameters is a dict written as the
+    Parameters block, with dicts as nested blocks (e.g. 'Materials').
+
+    encoding is one of ENCODINGS; HxByteRLE is only for byte data. The
+    data is encoded and written chunk by chunk, so no full copy of arr
+    is made. The encoded size, which the header gives for compressed
+    data, is filled in once the data is written.
+
+    level is the zlib compression level of HxZip. If threads is given,
+    HxZip data is compressed by a pool of that many threads, each chunk
+    as an independent block, see BlockCompressor.
+
+    Returns a dict with the 'offset' and encoded 'size' of the data in
+    the file and, if compressed in blocks, the 'blocks' as listed by
+    BlockCompressor.boundaries (else None).
+    """
+    arr = np.asanyarray(arr)
+    if encoding not in ENCODINGS:
+        raise ValueError('unknown encoding %r, not one of %r'%(encoding, ENCODINGS))
+    if arr.ndim not in (3, 4):
+        raise ValueError('expected an array indexed (x, y, z[, component]), not shape %r'%(arr.shape,))
+    element_type = element_types.get( arr.dtype.name )
+    if element_type is None:
+        raise ValueError('cannot write dtype %s'%arr.dtype)
+    if encoding=='HxByteRLE' and element_type!='byte':
+        raise ValueError('HxByteRLE encoding is only for byte data, not %s'%element_type)
+    if byte_order=='little':
+        header = '# AmiraMesh BINARY-LITTLE-ENDIAN 2.1'
+        dtype = arr.dtype.newbyteorder('<')
+    elif byte_order=='big':
+        header = '# AmiraMesh 3D BINARY 2.0'
+        dtype = arr.dtype.newbyteorder('>')
+    else:
+        raise ValueError('byte_order must be "little" or "big", not %r'%byte_order)
+
+    if arr.ndim==4 and arr.shape[3] > 1:
+        element_type = '%s[%d]'%(element_type, arr.shape[3])
+
+    lines = [header, '', '', 'define Lattice %d %d %d'%arr.shape[:3], '']
+    if parameters:
+        lines.append( 'Parameters {' )
+        lines.extend( format_parameters(parameters) )
+        lines.append( '}' )
+        lines.append( '' )
+    lines.append( 'Lattice { %s %s } @1'%(element_type, name) )
+
+    with open(filename, mode='wb') as fd:
+        fd.write( '\n'.join(lines).encode('ascii') )
+        size_offset = fd.tell()
+        if encoding!='raw':
+            # the size is filled in below
+            fd.write( b' '*(len(encoding)+3+SIZE_FIELD_WIDTH) )
+        fd.write( b'\n\n# Data section follows\n@1\n' )
+
+        offset = fd.tell()
+        if encoding=='HxZip' and threads is not None:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor( max_workers=threads ) as executor:
+                compressor = BlockCompressor( executor, level=level, max_pending=2*threads )
+                size = write_chunks( fd, arr, dtype, encoding, chunk_bytes, compressor )
+            blocks = compressor.boundaries
+        else:
+            compressor = None
+            if encoding=='HxZip':
+                compressor = zlib.compressobj( level )
+            size = write_chunks( fd, arr, dtype, encoding, chunk_bytes, compressor )
+            blocks = None
+        fd.write( b'\n' )
+
+        if encoding!='raw':
+            fd.seek( size_offset )
+            fd.write( ('(%s,%d)'%(encoding, size)).encode('ascii') )
+    return {'offset': offset,
+            'size': size,
+            'blocks': blocks,
+            }
+
+def write_chunks( fd, arr, dtype, encoding, chunk_bytes, compressor ):
+    """encode and write the data of arr, returning the encoded size"""
+    size = 0
+    for chunk in iter_chunks( arr, dtype, chunk_bytes=chunk_bytes ):
+        if encoding=='raw':
+            fd.write( chunk )
+            size += chunk.nbytes
+            continue
+        if encoding=='HxZip':
+            encoded = compressor.compress( chunk )
+        else:
+            encoded = rle_compress( chunk )
+        fd.write( encoded )
+        size += len(encoded)
+    if encoding=='HxZip':
+        encoded = compressor.flush()
+        fd.write( encoded )
+        size += len(encoded)
+    return size
+
+def iter_format_rows( arr, fmt, chunk_rows=FORMAT_CHUNK_ROWS ):
+    """yield the lines of text of the rows of a 2D array, each formatted by fmt
+
+    The rows are formatted chunk_rows at a time, each chunk by one %
+    operation rather than row by row.
+    """
+    arr = np.asarray(arr)
+    for start in range(0, len(arr), chunk_rows):
+        chunk = arr[start:start+chunk_rows]
+        yield (fmt*len(chunk)) % tuple(chunk.ravel().tolist())
+
+def write_surf( filename, vertices, patches, materials=None, binary=True, parameters=None,
+                chunk_rows=FORMAT_CHUNK_ROWS ):
+    """write a HyperSurface file
+
+    vertices is an (n, 3) array. patches is a list with a dict per
+    patch giving its 'Triangles', an (m, 3) array of 1-based vertex
+    indices, and its 'InnerRegion' and 'OuterRegion' (default 'Inside'
+    and 'Exterior'), 'BoundaryID' and 'BranchingPoints' (default 0).
+    materials is a dict of the fields of each material, e.g.
+    {'Inside': {'Id': 1, 'Color': [1, 0, 0]}}, written to the
+    Parameters block with any other parameters.
+
+    Binary files are big-endian, each array written at once. In ASCII
+    files the rows of an array are formatted and written chunk_rows at
+    a time.
+    """
+    all_parameters = {}
+    if materials:
+        all_parameters['Materials'] = materials
+    if parameters:
+        all_parameters.update( parameters )
+    vertices = np.asarray(vertices)
+    if vertices.ndim != 2 or vertices.shape[1] != 3:
+        raise ValueError('expected vertices of shape (n, 3), not %r'%(vertices.shape,))
+
+    def write_array( fd, arr, dtype, fmt ):
+        if binary:
+            fd.write( memoryview(np.ascontiguousarray(arr, dtype=dtype)) )
+            fd.write( b'\n' )
+        else:
+            for text in iter_format_rows( arr, fmt, chunk_rows=chunk_rows ):
+                fd.write( text.encode('ascii') )
+
+    with open(filename, mode='wb') as fd:
+        if binary:
+            fd.write( b'# HyperSurface 0.1 BINARY\n\n' )
+        else:
+            fd.write( b'# HyperSurface 0.1 ASCII\n\n' )
+        if all_parameters:
+            lines = ['Parameters {'] + format_parameters(all_parameters) + ['}', '', '']
+            fd.write( '\n'.join(lines).encode('ascii') )
+        fd.write( ('Vertices %d\n'%len(vertices)).encode('ascii') )
+        write_array( fd, vertices, '>f4', '\t%.9g %.9g %.9g\n' )
+        fd.write( b'NBranchingPoints 0\nNVerticesOnCurves 0\nBoundaryCurves 0\n' )
+        fd.write( ('Patches %d\n'%len(patches)).encode('ascii') )
+        for patch in patches:
+            triangles = np.asarray(patch['Triangles']).reshape(-1, 3)
+            lines = ['{',
+                     'InnerRegion %s'%patch.get('InnerRegion', 'Inside'),
+                     'OuterRegion %s'%patch.get('OuterRegion', 'Exterior'),
+                     'BoundaryID %d'%patch.get('BoundaryID', 0),
+                     'BranchingPoints %d'%patch.get('BranchingPoints', 0),
+                     '',
+                     'Triangles %d'%len(triangles),
+                     '']
+            fd.write( '\n'.join(lines).encode('ascii') )
+            write_array( fd, triangles, '>i4', '  %d %d %d\n' )
+            fd.write( b'}\n' )
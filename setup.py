@@ -1,5 +1,4 @@
-from distutils.core import setup, Command
-# you can also import from setuptools
+from setuptools import setup, Command
 
 class PyTest(Command):
     user_options = []
@@ -19,5 +18,6 @@ class PyTest(Command):
 setup(name='py_amira_file_reader',
       packages=['py_amira_file_reader'],
       version='0.0.1',
+      python_requires='>=3.8',
       cmdclass = {'test': PyTest},
 )
@@ -0,0 +1,72 @@
+import os, tempfile, shutil
+import numpy as np
+import nrrd
+import py_amira_file_reader.read_amira as read_amira
+from py_amira_file_reader.write_amira import write_amira
+from py_amira_file_reader.am_to_nrrd import convert_file_streaming, convert_file_detached
+
+def test_convert_streaming():
+    arr = (np.arange(9*7*5) % 4).astype(np.uint16).reshape(9,7,5)
+    parameters = {'Materials': {'Exterior': {'Id': 0}, 'Inside': {'Id': 1}},
+                  'BoundingBox': [0.0, 8.0, 1.0, 4.0, 0.0, 2.0],
+                  'CoordType': '"uniform"'}
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'labels.am')
+        for encoding in ['raw', 'HxZip']:
+            write_amira(fname, arr, parameters=parameters, encoding=encoding, byte_order='big')
+            for nrrd_encoding in ['gzip', 'raw']:
+                nrrd_fname = os.path.join(outdir, 'labels.nrrd')
+                csv_fname = os.path.join(outdir, 'labels.csv')
+                convert_file_streaming(fname, csv_fname, nrrd_fname, encoding=nrrd_encoding)
+                actual, header = nrrd.read(nrrd_fname)
+                assert (actual == arr).all()
+                assert header['endian'] == 'big'
+                assert header['encoding'] == nrrd_encoding
+                assert np.allclose(np.diag(header['space directions']), [1.0, 0.5, 0.5])
+                assert np.allclose(header['space origin'], [0.0, 1.0, 0.0])
+                assert open(csv_fname).read() == 'id,name\n0,Exterior\n1,Inside\n'
+    finally:
+        shutil.rmtree(outdir)
+
+def test_iter_section_data():
+    arr = (np.arange(11*6*5) // 3 % 7).astype(np.uint8).reshape(11,6,5)
+    expected = np.ascontiguousarray(arr.T).tobytes()
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'labels.am')
+        for encoding in ['raw', 'HxZip', 'HxByteRLE']:
+            write_amira(fname, arr, encoding=encoding)
+            section = read_amira.read_amira_header(fname)['sections'][0]
+            with open(fname, mode='rb') as fileobj:
+                chunks = list(read_amira.iter_section_data(fileobj, section, chunk_size=64))
+            assert max(len(chunk) for chunk in chunks) <= 64
+            assert b''.join(bytes(chunk) for chunk in chunks) == expected
+    finally:
+        shutil.rmtree(outdir)
+
+def test_convert_detached():
+    arr = (np.arange(9*7*5) % 4).astype(np.float32).reshape(9,7,5)
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'field.am')
+        nhdr_fname = os.path.join(outdir, 'field.nhdr')
+        raw_fname = os.path.join(outdir, 'field.raw')
+        csv_fname = os.path.join(outdir, 'field.csv')
+        for encoding in ['raw', 'HxZip']:
+            write_amira(fname, arr, parameters={'BoundingBox': [0.0, 8.0, 0.0, 6.0, 0.0, 4.0]},
+                        encoding=encoding)
+            convert_file_detached(fname, csv_fname, nhdr_fname, raw_fname)
+            actual, header = nrrd.read(nhdr_fname)
+            assert (actual == arr).all()
+            if encoding == 'raw':
+                # refers to the data in place
+                offset = read_amira.read_amira_header(fname)['sections'][0]['offset']
+                assert header['byte skip'] == offset
+                assert header['data file'] == 'field.am'
+                assert not os.path.exists(raw_fname)
+            else:
+                assert header['data file'] == 'field.raw'
+                assert os.path.getsize(raw_fname) == arr.nbytes
+    finally:
+        shutil.rmtree(outdir)
@@ -1,6 +1,7 @@
 from __future__ import print_function
 import py_amira_file_reader.read_amira as read_amira
-import os
+import os, tempfile, shutil, zlib, json
+import numpy as np
 
 def get_data_path(fname):
     tests_path = os.path.split( __file__ )[0]
@@ -56,3 +57,525 @@ def test_parse_ascii_mesh():
     import pprint
     pprint.pprint(data)
     print('---------------- ascii mesh data done -----')
+
+def test_am_mmap():
+    data_path = get_data_path('LHMask.am')
+    expected = read_amira.read_amira( data_path )['data'][-1]['data']
+    actual = read_amira.read_amira( data_path, mmap=True )['data'][-1]['data']
+    assert actual.shape == expected.shape
+    assert (actual == expected).all()
+    assert not actual.flags.writeable
+
+def test_read_header():
+    data_path = get_data_path('LHMask.am')
+    header = read_amira.read_amira_header( data_path )
+    assert header['info']['type'] == 'AmiraMesh'
+    assert header['data'][0]['define']['Lattice'] == [50,50,50]
+    assert len(header['sections']) == 1
+    section = header['sections'][0]
+    assert section['type'] == 'byte'
+    assert section['encoding'] == 'raw'
+    assert section['shape'] == (50,50,50)
+    with open(data_path,mode='rb') as fd:
+        fd.seek(section['offset'])
+        assert len(fd.read()) >= section['size']
+
+def test_read_header_ascii():
+    data_path = get_data_path('hybrid-testgrid-2d.am')
+    header = read_amira.read_amira_header( data_path )
+    sections = header['sections']
+    assert [s['id'] for s in sections] == [1,2,3]
+    assert sections[0]['shape'] == (16,)
+    assert sections[0]['type'] == 'float'
+    assert sections[0]['components'] == 2
+    assert sections[1]['shape'] == (11,)
+    assert sections[1]['components'] == 4
+
+def test_read_header_data_start_at_chunk_end():
+    arr = (np.arange(4*3*2) % 251).astype(np.uint8).reshape(4,3,2)
+    head = b'# AmiraMesh 3D BINARY 2.0\n\ndefine Lattice 4 3 2\n\nLattice { byte Data } @1\n\n'
+    # pad with a comment so that "@1" ends right at the end of the
+    # first chunk read, before its newline
+    pad = read_amira.HEADER_CHUNK_SIZE - len(head) - len(b'#\n@1')
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'boundary.am')
+        with open(fname, mode='wb') as fd:
+            fd.write(head + b'#' + b' '*pad + b'\n@1\n' + arr.T.tobytes() + b'\n')
+        header = read_amira.read_amira_header( fname )
+        roi = read_amira.read_amira_roi( fname, 1 )
+    finally:
+        shutil.rmtree(outdir)
+    assert header['sections'][0]['offset'] == read_amira.HEADER_CHUNK_SIZE+1
+    assert (roi == arr).all()
+
+def test_am_lazy():
+    data_path = get_data_path('LHMask.am')
+    expected = read_amira.read_amira( data_path )['data'][-1]['data']
+    lazy = read_amira.read_amira( data_path, lazy=True )['data'][-1]['data']
+    assert isinstance(lazy, read_amira.LazyArray)
+    assert lazy.shape == expected.shape
+    assert lazy.dtype == expected.dtype
+    assert lazy.nbytes == expected.nbytes
+    assert lazy[10,20,30] == expected[10,20,30]
+    arr = np.asarray(lazy)
+    assert (arr == expected).all()
+    assert np.asarray(lazy) is arr # decoded only once
+
+def test_am_lazy_relative_path():
+    data_path = get_data_path('LHMask.am')
+    expected = read_amira.read_amira( data_path )['data'][-1]['data']
+    cwd = os.getcwd()
+    outdir = tempfile.mkdtemp()
+    try:
+        os.chdir(os.path.dirname(data_path))
+        lazy = read_amira.read_amira( 'LHMask.am', lazy=True )['data'][-1]['data']
+        lazy_bytes = read_amira.read_amira( b'LHMask.am', lazy=True )['data'][-1]['data']
+        # the data is read after changing to another directory
+        os.chdir(outdir)
+        assert (np.asarray(lazy) == expected).all()
+        assert (np.asarray(lazy_bytes) == expected).all()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(outdir)
+
+def write_small_am(fname, arr, encoding):
+    # minimal binary AmiraMesh file with a single byte lattice
+    raw = np.ascontiguousarray(np.swapaxes(arr, 0, 2)).tobytes()
+    if encoding == 'HxZip':
+        encoded = zlib.compress(raw)
+        info = '(HxZip,%d)'%len(encoded)
+    elif encoding == 'HxByteRLE':
+        # every byte as a run of length one
+        encoded = np.column_stack((np.ones(len(raw), dtype=np.uint8),
+                                   np.frombuffer(raw, dtype=np.uint8))).tobytes()
+        info = '(HxByteRLE,%d)'%len(encoded)
+    else:
+        encoded = raw
+        info = ''
+    with open(fname, mode='wb') as fd:
+        fd.write(b'# AmiraMesh 3D BINARY 2.0\n\n')
+        fd.write(('define Lattice %d %d %d\n\n'%arr.shape).encode())
+        fd.write(b'Parameters {\n    CoordType "uniform"\n}\n\n')
+        fd.write(('Lattice { byte Data } @1%s\n\n'%info).encode())
+        fd.write(b'@1\n')
+        fd.write(encoded)
+        fd.write(b'\n')
+
+def test_am_hxzip():
+    arr = (np.arange(7*5*3) % 251).astype(np.uint8).reshape(7,5,3)
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'zip.am')
+        write_small_am(fname, arr, 'HxZip')
+        actual = read_amira.read_amira( fname )['data'][-1]['data']
+    finally:
+        shutil.rmtree(outdir)
+    assert actual.shape == arr.shape
+    assert (actual == arr).all()
+
+def test_zlib_decompress_into():
+    raw = (np.arange(10000) % 7).astype(np.uint8)
+    encoded = zlib.compress(raw.tobytes())
+    out = np.empty(10000, dtype=np.uint8)
+    read_amira.zlib_decompress_into( encoded, out, chunk_size=64 )
+    assert (out == raw).all()
+    for size in (9999, 10001):
+        out = np.empty(size, dtype=np.uint8)
+        try:
+            read_amira.zlib_decompress_into( encoded, out, chunk_size=64 )
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('length mismatch not detected')
+
+def test_rle_decompress():
+    # random mixture of repeat and literal blocks
+    rng = np.random.RandomState(42)
+    encoded = []
+    expected = []
+    for i in range(2000):
+        if rng.rand() < 0.7:
+            n = rng.randint(1, 128)
+            value = rng.randint(0, 256)
+            encoded.extend([n, value])
+            expected.extend([value]*n)
+        else:
+            n = rng.randint(0, 128)
+            values = rng.randint(0, 256, size=n).tolist()
+            encoded.extend([128+n] + values)
+            expected.extend(values)
+    encoded = bytes(bytearray(encoded))
+    expected = bytes(bytearray(expected))
+    assert read_amira.rle_decompress( encoded ) == expected
+    # a zero control byte ends the data
+    assert read_amira.rle_decompress( encoded + b'\x00\x05\x01' ) == expected
+    out = np.empty(len(expected), dtype=np.uint8)
+    read_amira.rle_decompress_into( encoded, out, chunk_size=1000 )
+    assert out.tobytes() == expected
+    part = read_amira.rle_decompress_into( encoded, chunk_size=100, start=1234, stop=56789 )
+    assert part.tobytes() == expected[1234:56789]
+    # blocks cut off at the ends of the windows of encoded data
+    for window_size in (1, 7, 128, 1000):
+        pieces = read_amira.iter_rle_decompress( read_amira.iter_windows(encoded, window_size) )
+        assert b''.join( piece.tobytes() for piece in pieces ) == expected
+    try:
+        read_amira.rle_decompress( encoded + b'\x85\x01' )
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('truncated data not detected')
+
+def test_am_element_types():
+    # float vector field in a little endian file
+    arr = np.arange(4*3*2*3, dtype='<f4').reshape(4,3,2,3)
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'float3.am')
+        with open(fname, mode='wb') as fd:
+            fd.write(b'# AmiraMesh BINARY-LITTLE-ENDIAN 2.1\n\n')
+            fd.write(b'define Lattice 4 3 2\n\n')
+            fd.write(b'Lattice { float[3] Data } @1\n\n')
+            fd.write(b'@1\n')
+            fd.write(np.ascontiguousarray(np.transpose(arr, (2,1,0,3))).tobytes())
+            fd.write(b'\n')
+        data = read_amira.read_amira( fname )
+        actual = data['data'][-1]['data']
+        header = read_amira.read_amira_header( fname )
+    finally:
+        shutil.rmtree(outdir)
+    assert actual.dtype == np.dtype('<f4')
+    assert actual.shape == (4,3,2,3)
+    assert (actual == arr).all()
+    assert header['sections'][0]['dtype'] == '<f4'
+    assert header['sections'][0]['size'] == arr.nbytes
+
+def test_ascii_mesh_dtypes():
+    data_path = get_data_path('hybrid-testgrid-2d.am')
+    data = read_amira.read_amira( data_path )
+    arrs = [row['data'] for row in data['data'] if 'data' in row]
+    assert arrs[0].dtype == np.float32
+    assert arrs[0].shape == (16,2)
+    assert arrs[0][1].tolist() == [0.5, 0.0]
+    assert arrs[1].dtype == np.int32
+    assert arrs[1].shape == (11,4)
+    assert arrs[1][-1].tolist() == [16, 14, 15, 15]
+    assert arrs[2].dtype == np.uint8
+    assert arrs[2].shape == (11,)
+
+def test_ascii_surf_dtypes():
+    data_path = get_data_path('tetrahedron.surf')
+    data = read_amira.read_amira( data_path )
+    vertices = data['data'][1]['Vertices']
+    assert vertices.dtype == np.float32
+    assert vertices[1].tolist() == [1.0, 1.0, -1.0]
+    triangles = data['data'][-1]['Triangles']
+    assert triangles.dtype == np.int32
+    assert triangles.shape == (4,3)
+    assert triangles[1].tolist() == [3, 2, 4]
+
+def test_read_roi():
+    data_path = get_data_path('LHMask.am')
+    full = read_amira.read_amira( data_path )['data'][-1]['data']
+    roi = read_amira.read_amira_roi( data_path, 1, x=slice(3,20), y=slice(5,7), z=slice(40,50) )
+    assert roi.shape == (17,2,10)
+    assert (roi == full[3:20,5:7,40:50]).all()
+    roi = read_amira.read_amira_roi( data_path, 1, x=slice(None,None,3), z=slice(10,2,-2) )
+    assert (roi == full[::3,:,10:2:-2]).all()
+
+def test_read_roi_compressed():
+    arr = (np.arange(9*8*7) % 251).astype(np.uint8).reshape(9,8,7)
+    outdir = tempfile.mkdtemp()
+    try:
+        for encoding in ('HxZip','HxByteRLE'):
+            fname = os.path.join(outdir, 'roi.am')
+            write_small_am(fname, arr, encoding)
+            assert (read_amira.read_amira( fname )['data'][-1]['data'] == arr).all()
+            roi = read_amira.read_amira_roi( fname, 1, x=slice(2,5), y=slice(1,8), z=slice(3,5) )
+            assert (roi == arr[2:5,1:8,3:5]).all()
+    finally:
+        shutil.rmtree(outdir)
+
+def test_am_order():
+    data_path = get_data_path('LHMask.am')
+    expected = read_amira.read_amira( data_path )['data'][-1]['data']
+    arr = read_amira.read_amira( data_path, order='xyz-F' )['data'][-1]['data']
+    assert arr.flags['F_CONTIGUOUS']
+    assert (arr == expected).all()
+    arr = read_amira.read_amira( data_path, order='zyx-C' )['data'][-1]['data']
+    assert arr.flags['C_CONTIGUOUS']
+    assert (arr == expected.T).all()
+
+def test_read_many():
+    fnames = [get_data_path('LHMask.am'), get_data_path('hybrid-testgrid-2d.am'),
+              get_data_path('does-not-exist.am')]
+    results = list(read_amira.read_amira_many( fnames, workers=2, max_in_flight=2 ))
+    assert [r[0] for r in results] == fnames
+    for fname, result, error in results[:2]:
+        assert error is None
+        expected = read_amira.read_amira( fname )
+        for row, expected_row in zip(result['data'], expected['data']):
+            if 'data' in row:
+                assert np.array_equal( row['data'], expected_row['data'] )
+                assert row['data'].shape == expected_row['data'].shape
+    fname, result, error = results[2]
+    assert result is None
+    assert isinstance(error, (IOError, OSError))
+
+def test_am_threads():
+    for fname in ['LHMask.am', 'hybrid-testgrid-2d.am']:
+        expected = read_amira.read_amira( get_data_path(fname) )
+        actual = read_amira.read_amira( get_data_path(fname), threads=2 )
+        assert len(actual['data']) == len(expected['data'])
+        for row, expected_row in zip(actual['data'], expected['data']):
+            if 'data' in row:
+                assert isinstance(row['data'], np.ndarray)
+                assert row['data'].shape == expected_row['data'].shape
+                assert (row['data'] == expected_row['data']).all()
+            else:
+                # blocks keep their type (OrderedDict)
+                for key in row:
+                    assert type(row[key]) == type(expected_row[key])
+
+def write_small_surf(fname, vertices, patches):
+    # minimal binary HyperSurface, with the triangles of each patch
+    with open(fname, mode='wb') as fd:
+        fd.write(b'# HyperSurface 0.1 BINARY\n\n')
+        fd.write(b'Parameters {\n    Materials {\n        Exterior {\n            id 1\n        }\n    }\n}\n\n')
+        fd.write(('Vertices %d\n'%len(vertices)).encode())
+        fd.write(np.asarray(vertices, dtype='>f4').tobytes())
+        fd.write(b'\nNBranchingPoints 0\nNVerticesOnCurves 0\nBoundaryCurves 0\n')
+        fd.write(('Patches %d\n'%len(patches)).encode())
+        for i, triangles in enumerate(patches):
+            fd.write(('{\nInnerRegion Inside\nOuterRegion Exterior\nBoundaryID %d\nBranchingPoints 0\n\n'%i).encode())
+            fd.write(('Triangles %d\n'%len(triangles)).encode())
+            fd.write(np.asarray(triangles, dtype='>i4').tobytes())
+            fd.write(b'\n}\n')
+
+def test_binary_surf_byte_order():
+    vertices = np.array([[-1,-1,-1],[1,1,-1],[1,-1,1],[-1,1,1]], dtype=np.float32)
+    triangles = np.array([[1,2,3],[3,2,4],[4,2,1],[1,3,4]], dtype=np.int32)
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'tetrahedron.surf')
+        write_small_surf(fname, vertices, [triangles])
+        data = read_amira.read_amira( fname )
+        native = read_amira.read_amira( fname, native=True )
+    finally:
+        shutil.rmtree(outdir)
+    assert data['info']['byte_order'] == 'big'
+    rows = dict( (key, row[key]) for row in data['data'] for key in row )
+    assert rows['Vertices'].dtype == np.dtype('>f4')
+    assert (rows['Vertices'] == vertices).all()
+    assert rows['Triangles'].dtype == np.dtype('>i4')
+    native_rows = dict( (key, row[key]) for row in native['data'] for key in row )
+    assert native_rows['Vertices'].dtype == np.dtype('=f4')
+    assert (native_rows['Vertices'] == vertices).all()
+    assert native_rows['Triangles'].dtype == np.dtype('=i4')
+    assert (native_rows['Triangles'] == triangles).all()
+
+def test_to_native():
+    foreign = np.arange(6, dtype=np.float32).astype(np.dtype(np.float32).newbyteorder('S'))
+    arr = read_amira.to_native( foreign )
+    assert arr.dtype.isnative
+    assert arr.tolist() == list(range(6))
+    assert np.shares_memory(arr, foreign) # swapped in place
+    foreign = np.arange(6, dtype=np.float32).astype(np.dtype(np.float32).newbyteorder('S'))
+    foreign.flags.writeable = False
+    arr = read_amira.to_native( foreign )
+    assert arr.dtype.isnative
+    assert arr.tolist() == list(range(6))
+    assert not np.shares_memory(arr, foreign)
+
+def test_read_surf_patches():
+    vertices = np.array([[-1,-1,-1],[1,1,-1],[1,-1,1],[-1,1,1]], dtype=np.float32)
+    patches = [np.array([[1,2,3],[3,2,4]]), np.zeros((0,3)), np.array([[4,2,1],[1,3,4],[1,2,3]])]
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'patches.surf')
+        write_small_surf(fname, vertices, patches)
+        data = read_amira.read_surf_patches( fname )
+    finally:
+        shutil.rmtree(outdir)
+    assert (data['vertices'] == vertices).all()
+    assert data['triangles'].dtype == np.int32
+    assert (data['triangles'] == np.concatenate(patches)).all()
+    assert data['patch_offsets'].tolist() == [0, 2, 2, 5]
+    assert [p['BoundaryID'] for p in data['patches']] == [0, 1, 2]
+    assert [p['Triangles'] for p in data['patches']] == [2, 0, 3]
+    assert {'Patches': 3} in data['data']
+
+def test_read_surf_patches_no_trailing_newline():
+    vertices = np.array([[-1,-1,-1],[1,1,-1],[1,-1,1],[-1,1,1]], dtype=np.float32)
+    triangles = np.array([[1,2,3],[3,2,4]])
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'patches.surf')
+        write_small_surf(fname, vertices, [triangles])
+        with open(fname, mode='rb+') as fd:
+            fd.truncate(os.path.getsize(fname)-1) # ends with "}"
+        data = read_amira.read_surf_patches( fname )
+    finally:
+        shutil.rmtree(outdir)
+    assert (data['triangles'] == triangles).all()
+    assert data['patch_offsets'].tolist() == [0, 2]
+
+def test_header_tokens():
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'header.am')
+        with open(fname, mode='wb') as fd:
+            fd.write(b'# AmiraMesh 3D BINARY 2.0\n\n')
+            fd.write(b'define Lattice 2 1 1\n\n')
+            fd.write(b'Parameters {\n')
+            fd.write(b'    Content "2x1x1 byte, uniform {coordinates}",\n')
+            fd.write(b'    BoundingBox -1.5 1.5 0 1e-3 .5 2,\n')
+            fd.write(b'    Seg2D 1\n')
+            fd.write(b'  # an indented comment\n')
+            fd.write(b'    CoordType "uniform"\n')
+            fd.write(b'}\n\n')
+            fd.write(b'Lattice { byte Data } @1\n\n')
+            fd.write(b'@1\n\x07\x08\n')
+        data = read_amira.read_amira( fname )
+    finally:
+        shutil.rmtree(outdir)
+    params = data['data'][1]['Parameters']
+    assert params['Content'] == '"2x1x1 byte, uniform {coordinates}"'
+    assert params['BoundingBox'] == [-1.5, 1.5, 0, 1e-3, 0.5, 2]
+    assert params['Seg2D'] == 1
+    assert params['CoordType'] == '"uniform"'
+    assert data['data'][-1]['data'].ravel().tolist() == [7, 8]
+
+class RecordingObserver(read_amira.Observer):
+    def __init__(self):
+        self.events = []
+    def start(self, phase, section=None):
+        self.events.append( ('start', phase, section) )
+    def end(self, phase, section=None, bytes_in=None, bytes_out=None):
+        self.events.append( ('end', phase, section, bytes_in, bytes_out) )
+
+def test_observer():
+    observer = RecordingObserver()
+    read_amira.add_observer( observer )
+    try:
+        data = read_amira.read_amira( get_data_path('LHMask.am') )
+    finally:
+        read_amira.remove_observer( observer )
+    arr = data['data'][-1]['data']
+    phases = [e[1] for e in observer.events if e[0]=='start']
+    assert phases[:3] == ['read', 'atoms', 'tokenize']
+    assert 'raw' in phases
+    # phases nest
+    stack = []
+    for event in observer.events:
+        if event[0]=='start':
+            stack.append( event[1] )
+        else:
+            assert stack.pop() == event[1]
+    assert stack == []
+    decoded = [e for e in observer.events if e[0]=='end' and e[1]=='raw']
+    assert decoded[0][2] == 1 # section id
+    assert decoded[0][4] == arr.nbytes
+    # nothing is reported once removed
+    n_events = len(observer.events)
+    read_amira.read_amira( get_data_path('LHMask.am') )
+    assert len(observer.events) == n_events
+
+def test_deeply_nested_header():
+    depth = 5000 # well past the recursion limit
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'nested.am')
+        with open(fname, mode='wb') as fd:
+            fd.write(b'# AmiraMesh 3D ASCII 2.0\n\n')
+            fd.write(b'Parameters {\n')
+            for i in range(depth):
+                fd.write(('Level%d {\n'%i).encode())
+            fd.write(b'Leaf 1 2 3\n')
+            fd.write(b'}\n'*(depth+1))
+        data = read_amira.read_amira( fname )
+    finally:
+        shutil.rmtree(outdir)
+    node = data['data'][-1]['Parameters']
+    for i in range(depth):
+        node = node['Level%d'%i]
+    assert node == {'Leaf': [1, 2, 3]}
+
+def test_header_cache():
+    arr = (np.arange(7*5*3) % 251).astype(np.uint8).reshape(7,5,3)
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'cached.am')
+        cache_dir = os.path.join(outdir, 'cache')
+        write_small_am(fname, arr, 'HxZip')
+        expected = read_amira.read_amira( fname )
+        cold = read_amira.read_amira( fname, cache_dir=cache_dir )
+        assert len(os.listdir(cache_dir)) == 1
+
+        observer = RecordingObserver()
+        read_amira.add_observer( observer )
+        try:
+            warm = read_amira.read_amira( fname, cache_dir=cache_dir )
+        finally:
+            read_amira.remove_observer( observer )
+        phases = [e[1] for e in observer.events if e[0]=='start']
+        assert 'tokenize' not in phases # header not parsed again
+        for data in [cold, warm]:
+            assert data['info'] == expected['info']
+            assert data['data'][:-1] == expected['data'][:-1]
+            assert [type(row) for row in data['data']] == [type(row) for row in expected['data']]
+            assert type(data['data'][1]['Parameters']) == type(expected['data'][1]['Parameters'])
+            assert (data['data'][-1]['data'] == arr).all()
+        header = read_amira.read_amira_header( fname, cache_dir=cache_dir )
+        assert header['sections'] == read_amira.read_amira_header( fname )['sections']
+        # entries are plain JSON, not pickles
+        entry_name = os.listdir(cache_dir)[0]
+        with open(os.path.join(cache_dir, entry_name)) as fd:
+            json.load(fd)
+
+        # a changed file is parsed again
+        write_small_am(fname, arr[:6], 'raw')
+        os.utime(fname, (0, 0))
+        changed = read_amira.read_amira( fname, cache_dir=cache_dir )
+        assert (changed['data'][-1]['data'] == arr[:6]).all()
+
+        # least recently used entries are evicted, once over the budget
+        cache = read_amira.HeaderCache( cache_dir, max_bytes=2*os.path.getsize(os.path.join(cache_dir, entry_name)) )
+        cache.put( fname, read_amira.index_amira(fname) )
+        assert cache.nbytes is not None
+        cache.max_bytes = 0
+        cache.put( fname, read_amira.index_amira(fname) )
+        assert os.listdir(cache_dir) == []
+    finally:
+        shutil.rmtree(outdir)
+
+def test_array_cache():
+    arr = (np.arange(7*5*3) % 251).astype(np.uint8).reshape(7,5,3)
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'a.am')
+        other = os.path.join(outdir, 'b.am')
+        write_small_am(fname, arr, 'HxByteRLE')
+        write_small_am(other, arr[::-1], 'HxZip')
+        cache = read_amira.ArrayCache( max_bytes=arr.nbytes )
+
+        read_amira.read_amira_header( fname )
+        read_amira.read_amira( fname, lazy=True, array_cache=cache )
+        assert len(cache) == 0 # nothing decoded
+
+        first = read_amira.read_amira( fname, array_cache=cache )['data'][-1]['data']
+        second = read_amira.read_amira( fname, array_cache=cache )['data'][-1]['data']
+        assert second is first
+        assert (first == arr).all()
+        assert not first.flags.writeable
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # the budget only holds one of the two
+        flipped = read_amira.read_amira( other, array_cache=cache )['data'][-1]['data']
+        assert (flipped == arr[::-1]).all()
+        assert cache.evictions == 1
+        assert cache.stats()['nbytes'] == arr.nbytes
+        read_amira.read_amira( fname, array_cache=cache )
+        assert cache.misses == 3
+    finally:
+        shutil.rmtree(outdir)
@@ -0,0 +1,105 @@
+import os, tempfile, shutil, zlib
+import numpy as np
+from test_reader import get_data_path
+import py_amira_file_reader.read_amira as read_amira
+from py_amira_file_reader.write_amira import write_amira, write_surf, rle_compress, adler32_combine
+
+def check_roundtrip(arr, encoding, parameters=None, byte_order='little'):
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'written.am')
+        # small chunks, so the data is written in several
+        write_amira(fname, arr, parameters=parameters, encoding=encoding,
+                    byte_order=byte_order, chunk_bytes=100)
+        data = read_amira.read_amira(fname)
+    finally:
+        shutil.rmtree(outdir)
+    actual = data['data'][-1]['data']
+    assert actual.shape == arr.shape
+    assert actual.dtype.newbyteorder('=') == arr.dtype
+    assert (actual == arr).all()
+    return data
+
+def test_write_encodings():
+    arr = (np.arange(17*13*11) % 5).astype(np.uint8).reshape(17,13,11)
+    arr[3:9] = 7 # long runs
+    for encoding in ['raw', 'HxZip', 'HxByteRLE']:
+        for byte_order in ['little', 'big']:
+            check_roundtrip(arr, encoding, byte_order=byte_order)
+
+def test_write_dtypes():
+    arr = np.linspace(-1, 1, 6*5*4*3).reshape(6,5,4,3) # vector field
+    for dtype in [np.int16, np.float32, np.float64]:
+        check_roundtrip((arr*100).astype(dtype), 'HxZip')
+
+def test_write_parameters():
+    # as read from a file
+    parameters = read_amira.read_amira(get_data_path('LHMask.am'))['data'][1]['Parameters']
+    parameters['Materials'] = {'Exterior': {'Id': 1},
+                               'Inside': {'Color': [1.0, 0.5, 0.0], 'Id': 2}}
+    arr = np.zeros((3,4,5), dtype=np.uint8)
+    data = check_roundtrip(arr, 'raw', parameters=parameters)
+    assert data['data'][1]['Parameters'] == parameters
+
+def test_rle_compress():
+    rng = np.random.RandomState(3)
+    arr = rng.randint(0, 3, 1000).astype(np.uint8)
+    arr[300:700] = 1 # runs longer than a block
+    encoded = rle_compress(arr)
+    out = np.empty(len(arr), dtype=np.uint8)
+    assert (read_amira.rle_decompress_into(encoded, out) == arr).all()
+
+def test_write_surf():
+    original = read_amira.read_amira(get_data_path('tetrahedron.surf'))
+    rows = dict( (key, row[key]) for row in original['data'] for key in row )
+    parameters = dict(rows['Parameters'])
+    materials = parameters.pop('Materials')
+    patches = [{'Triangles': rows['Triangles'][:3]},
+               {'Triangles': rows['Triangles'][3:], 'InnerRegion': 'Exterior',
+                'OuterRegion': 'Inside', 'BoundaryID': 2}]
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'written.surf')
+        for binary in [True, False]:
+            # few rows at a time, so ASCII arrays are written in chunks
+            write_surf(fname, rows['Vertices'], patches, materials=materials,
+                       binary=binary, parameters=parameters, chunk_rows=2)
+            data = read_amira.read_amira(fname)
+            assert data['info']['is_binary'] == binary
+            assert data['data'][0]['Parameters'] == rows['Parameters']
+            assert (data['data'][1]['Vertices'] == rows['Vertices']).all()
+            assert data['data'][5] == {'Patches': 2}
+            for patch, row in zip(patches, data['data'][6:]):
+                assert (row['Triangles'] == patch['Triangles']).all()
+                assert row['InnerRegion'] == patch.get('InnerRegion', 'Inside')
+                assert row['BoundaryID'] == patch.get('BoundaryID', 0)
+    finally:
+        shutil.rmtree(outdir)
+
+def test_write_hxzip_blocks():
+    arr = (np.arange(16*16*16) // 7 % 5).astype(np.uint16).reshape(16,16,16)
+    outdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(outdir, 'blocks.am')
+        written = write_amira(fname, arr, encoding='HxZip', level=1, threads=3,
+                              chunk_bytes=16*16*2*4) # blocks of 4 z planes
+        actual = read_amira.read_amira(fname)['data'][-1]['data']
+        with open(fname, mode='rb') as fd:
+            fd.seek(written['offset'])
+            encoded = fd.read(written['size'])
+    finally:
+        shutil.rmtree(outdir)
+    assert (actual == arr).all()
+    raw = np.ascontiguousarray(arr.T, dtype='<u2').tobytes()
+    assert zlib.decompress(encoded) == raw # one stream, checksum included
+    assert len(written['blocks']) == 4
+    # each block can be inflated on its own
+    raw_offset, encoded_offset = written['blocks'][2]
+    assert raw_offset == len(raw)//2
+    inflated = zlib.decompressobj(-zlib.MAX_WBITS).decompress(encoded[encoded_offset:])
+    assert inflated == raw[raw_offset:]
+
+def test_adler32_combine():
+    first, second = b'amira' * 1000, b'mesh' * 333
+    combined = adler32_combine(zlib.adler32(first), zlib.adler32(second), len(second))
+    assert combined == zlib.adler32(first + second)